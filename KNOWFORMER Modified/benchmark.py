@@ -0,0 +1,498 @@
+"""
+Micro-benchmarks of the Knowformer building blocks.
+
+    python benchmark.py attn --num_nodes 40943 --batch_size 16 --hidden_dim 32 --num_heads 4
+    python benchmark.py precision --data_path data/augmented --num_steps 20
+    python benchmark.py compile --data_path data/augmented --num_steps 10
+    python benchmark.py negative --data_path data/wn18rr --batch_size 64 --num_negative_sample 10
+    python benchmark.py dataloader --data_path data/wn18rr --num_workers 4
+    python benchmark.py eval --data_path data/wn18rr --test_batch_size 32 --eval_chunk_size 4096
+    python benchmark.py ddp --data_path data/augmented --num_processes 1 2 4 8
+"""
+import itertools
+import os
+import socket
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import einops
+import torch
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+
+from lightning import KnowformerLightningModule, TransductiveDataModule, get_filter_index, negative_sample
+from src.model import KnowformerLayer
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, repeat, warmup=2):
+    """mean wall time of fn() in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def saved_tensor_bytes(fn):
+    """bytes of the distinct storages that autograd saves for backward while running fn()"""
+    storages = dict()
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def proc_status(key):
+    """a memory field of /proc/self/status in bytes"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def peak_memory(fn, device):
+    """
+    peak bytes allocated while running fn(): from the caching allocator on cuda, from the resident set
+    high-water mark on linux cpu (which also counts memory of other threads), None otherwise
+    """
+    if device.type == 'cpu':
+        try:
+            # resets VmHWM to the current VmRSS
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            return None
+        base = proc_status('VmRSS')
+        fn()
+        return proc_status('VmHWM') - base
+    if device.type != 'cuda':
+        return None
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def reference_attn(layer, q, k, v, r_index):
+    # KnowformerLayer.attn before LinearAttentionFunction
+    split = lambda t: einops.rearrange(t, 'b l (h d) -> b h l d', h=layer.num_heads)
+    merge = lambda t: einops.rearrange(t, 'b h l d -> b l (h d)')
+    norm = lambda t: F.normalize(t, dim=-1)
+
+    batch_size = q.size(0)
+    num_node = q.size(1)
+
+    q, k, v = map(split, [q, k, v])
+    q, k = map(norm, [q, k])
+
+    added_weight = 0.333
+    specific_edge_types = torch.tensor([2, 3], device=r_index.device)
+    additional_weights = (r_index.unsqueeze(1).eq(specific_edge_types).any(dim=1).float() * (added_weight - 1)).unsqueeze(-1)
+    additional_weights = additional_weights.unsqueeze(1).unsqueeze(-1).expand_as(v)
+    k_weighted = k + k * additional_weights
+
+    full_rank_term = torch.eye(k.size(-1)).to(layer.device)
+    full_rank_term = einops.repeat(full_rank_term, 'd D -> b h d D', b=batch_size, h=layer.num_heads)
+    kvs = einops.einsum(k_weighted, v, 'b h v d, b h v D -> b h d D')
+    numerator = einops.einsum(q, kvs, 'b h v d, b h d D -> b h v D')
+    numerator = numerator + einops.reduce(v, 'b h (v w) d -> b h w d', 'sum', w=1) + v * num_node
+
+    denominator = einops.einsum(q, einops.reduce(k_weighted, 'b h v d -> b h d', 'sum'), 'b h v d, b h d -> b h v')
+    denominator = denominator + torch.full(denominator.shape, fill_value=num_node).to(layer.device) + num_node
+    denominator = einops.rearrange(denominator, 'b h (v w) -> b h v w', w=1)
+
+    output = numerator / denominator
+    return merge(output)
+
+
+def reference_negative_sample(filter_mask, num_negative_sample):
+    # lightning.negative_sample before the rejection sampler
+    p = torch.ones_like(filter_mask).float()
+    p = p * (~filter_mask)
+    return torch.multinomial(p, num_samples=num_negative_sample, replacement=True)
+
+
+def reference_collate_fn(batch, data_object):
+    # TransductiveKnowledgeGraph.train_collate_fn before the inversion was vectorized and the graphs moved to
+    # KnowformerLightningModule
+    batch_size = len(batch)
+    for i in range(batch_size//2, batch_size):
+        batch[i] = torch.flip(batch[i], [0])
+        batch[i][1] = torch.where(batch[i][1]%2==0, batch[i][1] + 1, batch[i][1] - 1)
+    h_index, r_index, t_index = torch.stack(batch, 0).long().unbind(-1)
+    graph = data_object.train_graph
+    return {
+        'h_index': h_index,
+        'r_index': r_index,
+        't_index': t_index,
+        **data_object.train_filters.to_batch(h_index, r_index, graph.num_nodes, data_object.filter_format),
+        'graph': graph,
+    }
+
+
+class TrainingStep(torch.nn.Module):
+    # DistributedDataParallel syncs the gradients of what its forward computes, which is training_step here
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, batched_data):
+        return self.module.training_step(batched_data)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def ddp_worker(rank, world_size, port, args, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    # the cores are split between the processes
+    torch.set_num_threads(max(1, args.num_threads // world_size))
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    datamodule = TransductiveDataModule(args.data_path, 0, args.batch_size, args.batch_size, storage=args.storage)
+    datamodule.setup('fit')
+    torch.manual_seed(args.seed)
+    module = KnowformerLightningModule(datamodule.num_relation, args.num_layer, 2, 3, args.hidden_dim, args.num_heads,
+                                       0.1, False, 'bce', 6, 'Adam', 1e-3, 0.0, 0.5)
+    module.set_graphs(datamodule.graphs, torch.device('cpu'))
+    module.log = lambda *args, **kwargs: None
+    # as main.py, see there
+    model = DistributedDataParallel(TrainingStep(module), static_graph=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+    loader = datamodule.train_dataloader()
+    def batches():
+        for epoch in itertools.count():
+            if isinstance(loader.sampler, DistributedSampler):
+                loader.sampler.set_epoch(epoch)
+            yield from loader
+    batches = batches()
+
+    def step():
+        batch = next(batches)
+        loss = model(batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return len(batch['h_index'])
+
+    for _ in range(args.num_warmup):
+        step()
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    num_triplets = torch.tensor(sum(step() for _ in range(args.num_steps)))
+    torch.distributed.barrier()
+    elapsed = time.perf_counter() - start
+    torch.distributed.all_reduce(num_triplets)
+    if rank == 0:
+        results.put((num_triplets.item(), elapsed))
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp(args):
+    # the cache is written once here and every process loads it
+    TransductiveDataModule(args.data_path, 0, args.batch_size, args.batch_size).prepare_data()
+    context = torch.multiprocessing.get_context('spawn')
+
+    print(f"ddp: data_path={args.data_path} batch_size={args.batch_size} per process num_steps={args.num_steps} "
+          f"num_threads={args.num_threads} storage={args.storage} backend=gloo")
+    print(f"{'processes':<12}{'triplets/s':>12}{'speedup':>12}")
+    baseline = None
+    for world_size in args.num_processes:
+        results = context.SimpleQueue()
+        torch.multiprocessing.spawn(ddp_worker, args=(world_size, free_port(), args, results), nprocs=world_size)
+        num_triplets, elapsed = results.get()
+        throughput = num_triplets / elapsed
+        baseline = baseline or throughput
+        print(f"{world_size:<12}{throughput:>12.1f}{throughput / baseline:>12.2f}")
+
+
+def bench_attn(args):
+    device = torch.device(args.device)
+    layer = KnowformerLayer(args.num_relation, 1, 1, args.hidden_dim, args.num_heads, 0.0).to(device)
+    shape = (args.batch_size, args.num_nodes, args.hidden_dim)
+    q, k, v = [torch.randn(shape, device=device, requires_grad=True) for _ in range(3)]
+    r_index = torch.randint(args.num_relation, (args.batch_size,), device=device)
+    grad = torch.randn(shape, device=device)
+
+    print(f"attn: batch_size={args.batch_size} num_nodes={args.num_nodes} hidden_dim={args.hidden_dim} "
+          f"num_heads={args.num_heads} device={device}")
+    print(f"{'':<12}{'forward ms':>12}{'fwd+bwd ms':>12}{'saved MB':>12}{'peak MB':>12}")
+    for name, attn in [('reference', lambda: reference_attn(layer, q, k, v, r_index)),
+                       ('fused', lambda: layer.attn(q, k, v, r_index))]:
+        with torch.no_grad():
+            forward = timeit(attn, device, args.repeat)
+        step = lambda: torch.autograd.backward(attn(), grad)
+        total = timeit(step, device, args.repeat)
+        saved = saved_tensor_bytes(attn) / 2 ** 20
+        peak = peak_memory(step, device)
+        peak = '-' if peak is None else '%.1f' % (peak / 2 ** 20)
+        print(f"{name:<12}{forward:>12.2f}{total:>12.2f}{saved:>12.1f}{peak:>12}")
+
+
+def bench_negative(args):
+    device = torch.device(args.device)
+    datamodule = TransductiveDataModule(args.data_path, 0, args.batch_size, args.batch_size)
+    datamodule.setup('fit')
+    batch = next(iter(datamodule.train_dataloader()))
+    batch_size, num_nodes = len(batch['h_index']), datamodule.graphs['train'].num_nodes
+    num_negative_sample = min(num_nodes, 2 ** args.num_negative_sample)
+    filter_index = get_filter_index(batch).to(device)
+    filter_mask = torch.zeros(batch_size, num_nodes, dtype=torch.bool, device=device)
+    filter_mask[filter_index[0], filter_index[1]] = True
+
+    print(f"negative: data_path={args.data_path} batch_size={batch_size} num_nodes={num_nodes} "
+          f"num_negative_sample={num_negative_sample} device={device}")
+    print(f"{'':<12}{'ms':>12}")
+    for name, sample in [('reference', lambda: reference_negative_sample(filter_mask, num_negative_sample)),
+                         ('rejection', lambda: negative_sample(filter_index, batch_size, num_nodes, num_negative_sample))]:
+        print(f"{name:<12}{timeit(sample, device, args.repeat):>12.3f}")
+
+
+def bench_dataloader(args):
+    device = torch.device(args.device)
+    datamodule = TransductiveDataModule(args.data_path, args.num_workers, args.batch_size, args.batch_size)
+    datamodule.setup('fit')
+    data_object = datamodule.data_object
+    # row by row collation with the graph in every batch, without persistent workers or pinned memory
+    reference = lambda: DataLoader(data_object.train_triplets.clone()[data_object.train_triplets[:, 1] % 2 == 0],
+                                   shuffle=True, batch_size=args.batch_size, num_workers=args.num_workers,
+                                   collate_fn=partial(reference_collate_fn, data_object=data_object))
+
+    print(f"dataloader: data_path={args.data_path} batch_size={args.batch_size} num_workers={args.num_workers} "
+          f"num_batches={args.num_batches} num_epochs={args.num_epochs} device={device}")
+    print(f"{'':<12}{'batches/s':>12}")
+    for name, make_loader in [('reference', reference), ('current', datamodule.train_dataloader)]:
+        loader = make_loader()
+        start = time.perf_counter()
+        for _ in range(args.num_epochs):
+            for _, batch in zip(range(args.num_batches), loader):
+                # what Lightning moves to the device with every batch
+                batch = {key: value.to(device) for key, value in batch.items()}
+        synchronize(device)
+        print(f"{name:<12}{args.num_epochs * args.num_batches / (time.perf_counter() - start):>12.1f}")
+
+
+def bench_eval(args):
+    device = torch.device(args.device)
+    datamodule = TransductiveDataModule(args.data_path, 0, args.test_batch_size, args.test_batch_size)
+    datamodule.setup('fit')
+    batch = next(iter(datamodule.test_dataloader()))
+    batch = {key: value.to(device) for key, value in batch.items()}
+
+    print(f"eval: data_path={args.data_path} test_batch_size={args.test_batch_size} "
+          f"num_nodes={datamodule.graphs['test'].num_nodes} device={device}")
+    print(f"{'':<12}{'ms':>12}{'peak MB':>12}{'same ranks':>12}")
+    ranks = None
+    for name, eval_chunk_size in [('full', 0), ('chunked', args.eval_chunk_size)]:
+        torch.manual_seed(args.seed)
+        module = KnowformerLightningModule(datamodule.num_relation, args.num_layer, 2, 3, args.hidden_dim, args.num_heads,
+                                           0.1, False, 'ce', 6, 'Adam', 1e-3, 0.0, 0.5,
+                                           eval_chunk_size=eval_chunk_size).to(device).eval()
+        module.set_graphs(datamodule.graphs, device)
+        batched_data = module.add_graph(dict(batch), 'test')
+
+        def evaluate():
+            # the same propagation noise for both
+            torch.manual_seed(args.seed)
+            with torch.no_grad():
+                return module.evaluate_ranks(batched_data)
+        elapsed = timeit(evaluate, device, args.repeat)
+        peak = peak_memory(evaluate, device)
+        peak = '-' if peak is None else '%.1f' % (peak / 2 ** 20)
+        same = '' if ranks is None else str(torch.equal(ranks, evaluate()))
+        ranks = evaluate()
+        print(f"{name:<12}{elapsed:>12.1f}{peak:>12}{same:>12}")
+
+
+def bench_precision(args):
+    device = torch.device(args.device)
+    datamodule = TransductiveDataModule(args.data_path, 0, args.batch_size, args.test_batch_size)
+    datamodule.setup('fit')
+    train_batches = [batch for _, batch in zip(range(args.num_steps), datamodule.train_dataloader())]
+    valid_batches = [batch for _, batch in zip(range(args.num_valid_steps), datamodule.val_dataloader())]
+    to_device = lambda batch: {key: value.to(device) for key, value in batch.items()}
+
+    print(f"precision: data_path={args.data_path} batch_size={args.batch_size} num_steps={args.num_steps} "
+          f"num_valid_steps={args.num_valid_steps} device={device}")
+    print(f"{'':<12}{'queries/s':>12}{'saved MB':>12}{'valid mrr':>12}")
+    for name, dtype in [('fp32', None), ('bf16', torch.bfloat16)]:
+        # same initialization and data order for both precisions
+        torch.manual_seed(args.seed)
+        module = KnowformerLightningModule(datamodule.num_relation, args.num_layer, 2, 3, args.hidden_dim, args.num_heads,
+                                           0.1, False, 'bce', 6, 'Adam', args.learning_rate, 0.0, 0.5).to(device)
+        module.set_graphs(datamodule.graphs, device)
+        module.log = lambda *args, **kwargs: None
+        optimizer = torch.optim.Adam(module.parameters(), lr=args.learning_rate)
+        # the same autocast region as the bf16-mixed precision of the Lightning trainer
+        autocast = lambda: torch.autocast(device.type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+        def step(batch):
+            with autocast():
+                loss = module.training_step(to_device(batch))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        module.train()
+        saved = saved_tensor_bytes(lambda: step(train_batches[0])) / 2 ** 20
+        synchronize(device)
+        start = time.perf_counter()
+        for batch in train_batches[1:]:
+            step(batch)
+        synchronize(device)
+        throughput = sum(len(batch['h_index']) for batch in train_batches[1:]) / (time.perf_counter() - start)
+
+        module.eval()
+        with torch.no_grad(), autocast():
+            for batch_idx, batch in enumerate(valid_batches):
+                module.validation_step(to_device(batch), batch_idx)
+        mrr = module.ranking_metrics.compute()['mrr'].item()
+        print(f"{name:<12}{throughput:>12.1f}{saved:>12.1f}{mrr:>12.4f}")
+
+
+def bench_compile(args):
+    device = torch.device(args.device)
+    datamodule = TransductiveDataModule(args.data_path, 0, args.batch_size, args.batch_size)
+    datamodule.setup('fit')
+    batches = [batch for _, batch in zip(range(args.num_warmup + args.num_steps), datamodule.train_dataloader())]
+    to_device = lambda batch: {key: value.to(device) for key, value in batch.items()}
+
+    print(f"compile: data_path={args.data_path} batch_size={args.batch_size} num_warmup={args.num_warmup} "
+          f"num_steps={args.num_steps} device={device}")
+    print(f"{'':<12}{'warmup s':>12}{'step ms':>12}{'graphs':>12}{'breaks':>12}")
+    for compile in [False, True]:
+        torch.manual_seed(args.seed)
+        module = KnowformerLightningModule(datamodule.num_relation, args.num_layer, 2, 3, args.hidden_dim, args.num_heads,
+                                           0.1, False, 'bce', 6, 'Adam', 1e-3, 0.0, 0.5, compile=compile).to(device)
+        module.set_graphs(datamodule.graphs, device)
+        module.log = lambda *args, **kwargs: None
+        optimizer = torch.optim.Adam(module.parameters(), lr=1e-3)
+
+        def step(batch):
+            loss = module.training_step(to_device(batch))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        # the first steps compile the layers for the shapes of the first batches, later ones reuse the graphs
+        torch._dynamo.reset()
+        start = time.perf_counter()
+        for batch in batches[:args.num_warmup]:
+            step(batch)
+        synchronize(device)
+        warmup = time.perf_counter() - start
+        start = time.perf_counter()
+        for batch in batches[args.num_warmup:]:
+            step(batch)
+        synchronize(device)
+        elapsed = (time.perf_counter() - start) / args.num_steps * 1000
+
+        # graphs and graph breaks of one KnowformerLayer on the last batch
+        batch = to_device(batches[-1])
+        graph = module.graphs['train']
+        h_index, r_index = batch['h_index'], batch['r_index']
+        z = module.model.query_embedding(r_index)
+        x = z.new_zeros(len(h_index), graph.num_nodes, args.hidden_dim)
+        explain = torch._dynamo.explain(module.model.layers[0].forward)(h_index, r_index, x, z, z.unsqueeze(1), graph.csr)
+        name = 'compiled' if compile else 'eager'
+        print(f"{name:<12}{warmup:>12.1f}{elapsed:>12.1f}{explain.graph_count:>12}{explain.graph_break_count:>12}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--repeat', default=10, type=int)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    attn_parser = subparsers.add_parser('attn', help="KnowformerLayer.attn against the pre-fusion implementation")
+    attn_parser.add_argument('--num_nodes', default=40943, type=int)
+    attn_parser.add_argument('--batch_size', default=16, type=int)
+    attn_parser.add_argument('--hidden_dim', default=32, type=int)
+    attn_parser.add_argument('--num_heads', default=4, type=int)
+    attn_parser.add_argument('--num_relation', default=22, type=int)
+    attn_parser.set_defaults(func=bench_attn)
+
+    negative_parser = subparsers.add_parser('negative', help="negative sampling against the dense multinomial sampler")
+    negative_parser.add_argument('--data_path', default='data/wn18rr', type=str)
+    negative_parser.add_argument('--batch_size', default=64, type=int)
+    negative_parser.add_argument('--num_negative_sample', default=10, type=int, help="log2 of the number of negatives")
+    negative_parser.set_defaults(func=bench_negative)
+
+    dataloader_parser = subparsers.add_parser('dataloader', help="training batches per second with and without the graph in them")
+    dataloader_parser.add_argument('--data_path', default='data/wn18rr', type=str)
+    dataloader_parser.add_argument('--batch_size', default=16, type=int)
+    dataloader_parser.add_argument('--num_workers', default=4, type=int)
+    dataloader_parser.add_argument('--num_batches', default=200, type=int, help="batches per epoch")
+    dataloader_parser.add_argument('--num_epochs', default=3, type=int)
+    dataloader_parser.set_defaults(func=bench_dataloader)
+
+    eval_parser = subparsers.add_parser('eval', help="filtered ranking with all entities scored at once or in chunks")
+    eval_parser.add_argument('--data_path', default='data/wn18rr', type=str)
+    eval_parser.add_argument('--test_batch_size', default=32, type=int)
+    eval_parser.add_argument('--eval_chunk_size', default=4096, type=int)
+    eval_parser.add_argument('--num_layer', default=1, type=int)
+    eval_parser.add_argument('--hidden_dim', default=32, type=int)
+    eval_parser.add_argument('--num_heads', default=4, type=int)
+    eval_parser.add_argument('--seed', default=2023, type=int)
+    eval_parser.set_defaults(func=bench_eval)
+
+    precision_parser = subparsers.add_parser('precision', help="training throughput, memory and MRR in fp32 and bf16")
+    precision_parser.add_argument('--data_path', default='data/augmented', type=str)
+    precision_parser.add_argument('--batch_size', default=16, type=int)
+    precision_parser.add_argument('--test_batch_size', default=16, type=int)
+    precision_parser.add_argument('--num_steps', default=20, type=int)
+    precision_parser.add_argument('--num_valid_steps', default=10, type=int)
+    precision_parser.add_argument('--num_layer', default=2, type=int)
+    precision_parser.add_argument('--hidden_dim', default=32, type=int)
+    precision_parser.add_argument('--num_heads', default=4, type=int)
+    precision_parser.add_argument('--learning_rate', default=5e-3, type=float)
+    precision_parser.add_argument('--seed', default=2023, type=int)
+    precision_parser.set_defaults(func=bench_precision)
+
+    compile_parser = subparsers.add_parser('compile', help="training step time and compilation cost with --compile")
+    compile_parser.add_argument('--data_path', default='data/augmented', type=str)
+    compile_parser.add_argument('--batch_size', default=16, type=int)
+    compile_parser.add_argument('--num_warmup', default=3, type=int)
+    compile_parser.add_argument('--num_steps', default=10, type=int)
+    compile_parser.add_argument('--num_layer', default=2, type=int)
+    compile_parser.add_argument('--hidden_dim', default=32, type=int)
+    compile_parser.add_argument('--num_heads', default=4, type=int)
+    compile_parser.add_argument('--seed', default=2023, type=int)
+    compile_parser.set_defaults(func=bench_compile)
+
+    ddp_parser = subparsers.add_parser('ddp', help="training throughput of gloo data parallel CPU processes")
+    ddp_parser.add_argument('--data_path', default='data/augmented', type=str)
+    ddp_parser.add_argument('--batch_size', default=16, type=int, help="per process")
+    ddp_parser.add_argument('--num_processes', default=[1, 2, 4, 8], type=int, nargs='+')
+    ddp_parser.add_argument('--num_threads', default=os.cpu_count(), type=int, help="split between the processes")
+    ddp_parser.add_argument('--storage', default='mmap', type=str)
+    ddp_parser.add_argument('--num_warmup', default=2, type=int)
+    ddp_parser.add_argument('--num_steps', default=10, type=int)
+    ddp_parser.add_argument('--num_layer', default=2, type=int)
+    ddp_parser.add_argument('--hidden_dim', default=32, type=int)
+    ddp_parser.add_argument('--num_heads', default=4, type=int)
+    ddp_parser.add_argument('--seed', default=2023, type=int)
+    ddp_parser.set_defaults(func=bench_ddp)
+
+    args = parser.parse_args()
+    args.func(args)
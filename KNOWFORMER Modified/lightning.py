@@ -1,98 +1,266 @@
+import os
 from copy import deepcopy
 from functools import partial
 
 import einops
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.optim.lr_scheduler import LambdaLR
 import pytorch_lightning as pl
 
-from src.model import Knowformer
-from src.data import TransductiveKnowledgeGraph, InductiveKnowledgeGraph
-from src.metric import MRMetric, MRRMetric, HitsMetric
+from src.model import Knowformer, CHECKPOINT_MODES
+from src.data import (TransductiveKnowledgeGraph, InductiveKnowledgeGraph, RelationGroupedBatchSampler, TripletDataset,
+                      count_lines, subgraph_collate_fn)
+from src.metric import RankingMetrics
+from src.rspmm import BACKENDS
 
 
 class TransductiveDataModule(pl.LightningDataModule):
-    def __init__(self, data_path, num_workers, batch_size, test_batch_size):
+    def __init__(self, data_path, num_workers, batch_size, test_batch_size, filter_format='sparse', use_cache=True,
+                 storage='memory', group_by_relation=False, subgraph_hops=0, subgraph_budget=0):
         super().__init__()
         self.data_path = data_path
         self.batch_size = batch_size
         self.test_batch_size = test_batch_size
         self.num_workers = num_workers
+        self.filter_format = filter_format
+        self.use_cache = use_cache
+        self.storage = storage
+        # batch queries of the same relation together
+        self.group_by_relation = group_by_relation
+        # if > 0, train on the subgraph_hops neighbourhood of the batch heads instead of the whole train graph
+        self.subgraph_hops = subgraph_hops
+        self.subgraph_budget = subgraph_budget
         
-        self.data_object = TransductiveKnowledgeGraph(self.data_path)
-        self.num_relation = self.data_object.num_relation
+        # the model is built before setup, the relations are counted without reading the dataset
+        self.num_relation = count_lines(os.path.join(self.data_path, 'relations.txt'))
+        # the dataset and the graph of the batches of every dataloader, see setup
+        self.data_object = None
+        self.graphs = None
+        # with torch.distributed, every process loads the queries of its rank only
+        self.num_replicas = 1
+        self.rank = 0
+        # workers are kept across epochs, batches are pinned for the copy to the GPU
+        self.loader_kwargs = dict(num_workers=self.num_workers, persistent_workers=self.num_workers > 0,
+                                  pin_memory=torch.cuda.is_available())
+    
+    def prepare_data(self):
+        # called in one process per node before setup, the preprocessed cache written here is then
+        # loaded by every process instead of preprocessed again
+        if self.use_cache:
+            TransductiveKnowledgeGraph.load_data(self.data_path)
+    
+    def setup(self, stage=None):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.num_replicas, self.rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+        if self.data_object is not None:
+            return
+        # with storage='memory' the training triplets are shuffled from the seed of pl.seed_everything,
+        # which is the same in all processes
+        self.data_object = TransductiveKnowledgeGraph(self.data_path, filter_format=self.filter_format, use_cache=self.use_cache,
+                                              storage=self.storage, seed=distributed_seed())
+        # batches only carry queries and filters, KnowformerLightningModule keeps a copy of the graphs on its device
+        self.graphs = {
+            'train': self.data_object.train_graph,
+            # val_dataloader iterates the test queries
+            'valid': self.data_object.test_graph,
+            'test': self.data_object.test_graph,
+        }
         
     def train_dataloader(self):
-        return DataLoader(self.data_object.train_triplets.clone()[self.data_object.train_triplets[:, 1]%2==0], 
+        triplets = TripletDataset(self.data_object.train_triplets, self.data_object.train_query_index)
+        collate_fn = self.data_object.train_collate_fn
+        if self.subgraph_hops > 0:
+            collate_fn = partial(subgraph_collate_fn, collate_fn=collate_fn, graph=self.data_object.train_graph, 
+                                 num_hop=self.subgraph_hops, node_budget=self.subgraph_budget)
+        if self.group_by_relation:
+            return DataLoader(triplets, 
+                              batch_sampler=RelationGroupedBatchSampler(triplets.relations, self.batch_size, shuffle=True,
+                                                                        num_replicas=self.num_replicas, rank=self.rank,
+                                                                        seed=distributed_seed()), 
+                              collate_fn=collate_fn,
+                              **self.loader_kwargs)
+        if self.num_replicas > 1:
+            return DataLoader(triplets, 
+                              sampler=DistributedSampler(triplets, self.num_replicas, self.rank, shuffle=True,
+                                                         seed=distributed_seed()), 
+                              collate_fn=collate_fn,
+                              batch_size=self.batch_size, 
+                              **self.loader_kwargs)
+        return DataLoader(triplets, 
                           shuffle=True, 
-                          collate_fn=self.data_object.train_collate_fn,
+                          collate_fn=collate_fn,
                           batch_size=self.batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
 
     def val_dataloader(self):
-        return DataLoader(self.data_object.test_triplets.clone(), 
+        triplets = TripletDataset(self.data_object.test_triplets, 
+                                  eval_shard(len(self.data_object.test_triplets), self.num_replicas, self.rank))
+        if self.group_by_relation:
+            return DataLoader(triplets, 
+                              batch_sampler=RelationGroupedBatchSampler(triplets.relations, self.test_batch_size), 
+                              collate_fn=self.data_object.test_collate_fn, 
+                              **self.loader_kwargs)
+        return DataLoader(triplets, 
                           shuffle=False, 
                           collate_fn=self.data_object.test_collate_fn, 
                           batch_size=self.test_batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
     
     def test_dataloader(self):
-        return DataLoader(self.data_object.test_triplets.clone(), 
+        triplets = TripletDataset(self.data_object.test_triplets, 
+                                  eval_shard(len(self.data_object.test_triplets), self.num_replicas, self.rank))
+        return DataLoader(triplets, 
                           shuffle=False, 
                           collate_fn=self.data_object.test_collate_fn, 
                           batch_size=self.test_batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
         
 
 class InductiveDataModule(pl.LightningDataModule):
-    def __init__(self, data_path, num_workers, batch_size, test_batch_size):
+    def __init__(self, data_path, num_workers, batch_size, test_batch_size, filter_format='sparse', use_cache=True,
+                 storage='memory', group_by_relation=False, subgraph_hops=0, subgraph_budget=0):
         super().__init__()
         self.data_path = data_path
         self.batch_size = batch_size
         self.test_batch_size = test_batch_size
         self.num_workers = num_workers
+        self.filter_format = filter_format
+        self.use_cache = use_cache
+        self.storage = storage
+        # batch queries of the same relation together
+        self.group_by_relation = group_by_relation
+        # if > 0, train on the subgraph_hops neighbourhood of the batch heads instead of the whole train graph
+        self.subgraph_hops = subgraph_hops
+        self.subgraph_budget = subgraph_budget
         
-        self.data_object = InductiveKnowledgeGraph(self.data_path)
-        self.num_relation = self.data_object.num_relation
+        # the model is built before setup, the relations are counted without reading the dataset
+        self.num_relation = count_lines(os.path.join(self.data_path, 'relations.txt'))
+        # the dataset and the graph of the batches of every dataloader, see setup
+        self.data_object = None
+        self.graphs = None
+        # with torch.distributed, every process loads the queries of its rank only
+        self.num_replicas = 1
+        self.rank = 0
+        # workers are kept across epochs, batches are pinned for the copy to the GPU
+        self.loader_kwargs = dict(num_workers=self.num_workers, persistent_workers=self.num_workers > 0,
+                                  pin_memory=torch.cuda.is_available())
+    
+    def prepare_data(self):
+        # called in one process per node before setup, the preprocessed cache written here is then
+        # loaded by every process instead of preprocessed again
+        if self.use_cache:
+            InductiveKnowledgeGraph.load_data(self.data_path)
+    
+    def setup(self, stage=None):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.num_replicas, self.rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+        if self.data_object is not None:
+            return
+        self.data_object = InductiveKnowledgeGraph(self.data_path, filter_format=self.filter_format, use_cache=self.use_cache,
+                                              storage=self.storage)
+        # batches only carry queries and filters, KnowformerLightningModule keeps a copy of the graphs on its device
+        self.graphs = {
+            'train': self.data_object.train_graph,
+            # val_dataloader iterates the test queries
+            'valid': self.data_object.test_graph,
+            'test': self.data_object.test_graph,
+        }
         
     def train_dataloader(self):
-        return DataLoader(self.data_object.train_triplets.clone()[self.data_object.train_triplets[:, 1]%2==0], 
+        triplets = TripletDataset(self.data_object.train_triplets, self.data_object.train_query_index)
+        collate_fn = self.data_object.train_collate_fn
+        if self.subgraph_hops > 0:
+            collate_fn = partial(subgraph_collate_fn, collate_fn=collate_fn, graph=self.data_object.train_graph, 
+                                 num_hop=self.subgraph_hops, node_budget=self.subgraph_budget)
+        if self.group_by_relation:
+            return DataLoader(triplets, 
+                              batch_sampler=RelationGroupedBatchSampler(triplets.relations, self.batch_size, shuffle=True,
+                                                                        num_replicas=self.num_replicas, rank=self.rank,
+                                                                        seed=distributed_seed()), 
+                              collate_fn=collate_fn,
+                              **self.loader_kwargs)
+        if self.num_replicas > 1:
+            return DataLoader(triplets, 
+                              sampler=DistributedSampler(triplets, self.num_replicas, self.rank, shuffle=True,
+                                                         seed=distributed_seed()), 
+                              collate_fn=collate_fn,
+                              batch_size=self.batch_size, 
+                              **self.loader_kwargs)
+        return DataLoader(triplets, 
                           shuffle=True, 
-                          collate_fn=self.data_object.train_collate_fn,
+                          collate_fn=collate_fn,
                           batch_size=self.batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
 
     def val_dataloader(self):
-        return DataLoader(self.data_object.test_triplets.clone(), 
+        triplets = TripletDataset(self.data_object.test_triplets, 
+                                  eval_shard(len(self.data_object.test_triplets), self.num_replicas, self.rank))
+        if self.group_by_relation:
+            return DataLoader(triplets, 
+                              batch_sampler=RelationGroupedBatchSampler(triplets.relations, self.test_batch_size), 
+                              collate_fn=self.data_object.test_collate_fn, 
+                              **self.loader_kwargs)
+        return DataLoader(triplets, 
                           shuffle=False, 
                           collate_fn=self.data_object.test_collate_fn, 
                           batch_size=self.test_batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
     
     def test_dataloader(self):
-        return DataLoader(self.data_object.test_triplets.clone(), 
+        triplets = TripletDataset(self.data_object.test_triplets, 
+                                  eval_shard(len(self.data_object.test_triplets), self.num_replicas, self.rank))
+        return DataLoader(triplets, 
                           shuffle=False, 
                           collate_fn=self.data_object.test_collate_fn, 
                           batch_size=self.test_batch_size, 
-                          num_workers=self.num_workers)
+                          **self.loader_kwargs)
 
 
 class KnowformerLightningModule(pl.LightningModule):
     def __init__(self, num_relation, num_layer, num_qk_layer, num_v_layer, hidden_dim, num_heads, drop,
-                 remove_all, loss_fn, num_negative_sample, optimizer, learning_rate, weight_decay, adversarial_temperature):
+                 remove_all, loss_fn, num_negative_sample, optimizer, learning_rate, weight_decay, adversarial_temperature,
+                 rspmm_backend='vectorized', num_bases=0, node_budget=0, activation_checkpoint='none', compile=False,
+                 hard_negative_cache=0, eval_chunk_size=0):
         super().__init__()
         self.save_hyperparameters()
         
         self.model = Knowformer(self.hparams.num_relation, self.hparams.num_layer, self.hparams.num_qk_layer, self.hparams.num_v_layer, 
-                                self.hparams.hidden_dim, self.hparams.num_heads, self.hparams.drop)
+                                self.hparams.hidden_dim, self.hparams.num_heads, self.hparams.drop, self.hparams.rspmm_backend,
+                                self.hparams.num_bases, self.hparams.node_budget, self.hparams.activation_checkpoint,
+                                self.hparams.compile)
+        
+        self.ranking_metrics = RankingMetrics(self.hparams.num_relation, ks=(1, 3, 10))
+        # per relation metrics of the last validation / test epoch, see log_ranking_metrics
+        self.relation_metrics = dict()
+        
+        # if > 0, reuse this many of the highest scoring negatives of the previous visit of every training query
+        self.negative_cache = None
+        if self.hparams.hard_negative_cache > 0:
+            self.negative_cache = HardNegativeCache(self.hparams.hard_negative_cache, self.hparams.num_relation)
         
-        self.mr_metric_fn = MRMetric()
-        self.mrr_metric_fn = MRRMetric()
-        self.hits1_metric_fn = HitsMetric(topk=1)
-        self.hits3_metric_fn = HitsMetric(topk=3)
-        self.hits10_metric_fn = HitsMetric(topk=10)
+        # 'train', 'valid' and 'test' graphs, see setup
+        self.graphs = None
+    
+    def setup(self, stage):
+        self.set_graphs(self.trainer.datamodule.graphs, self.trainer.strategy.root_device)
+    
+    def set_graphs(self, graphs, device):
+        # the graphs are moved to the device once here, instead of with every batch;
+        # transductive splits share one graph, which is moved only once
+        moved = {}
+        self.graphs = {}
+        for split, graph in graphs.items():
+            if id(graph) not in moved:
+                moved[id(graph)] = graph.to(device)
+            self.graphs[split] = moved[id(graph)]
+    
+    def add_graph(self, batched_data, split):
+        # subgraph training batches bring their own graph
+        if 'graph' not in batched_data:
+            batched_data['graph'] = self.graphs[split]
+        return batched_data
 
     def remove_edge(self, batched_data):
         h_index, r_index, t_index, graph = (batched_data['h_index'], 
@@ -105,15 +273,11 @@ class KnowformerLightningModule(pl.LightningModule):
         
         if self.hparams.remove_all:
             # remove all edges between head and tail entities
-            encode_fn = lambda x, y: x + y * graph.num_nodes
-            source_hash = encode_fn(graph.edge_index[:, 0], graph.edge_index[:, 2])
-            target_hash = encode_fn(h_index_remove, t_index_remove)
-            mask = ~torch.isin(source_hash, target_hash)
+            edge_id = graph.find_edges(h_index_remove, t_index_remove)
         else:
-            encode_fn = lambda x, y, z: z + (x + y * graph.num_nodes) * graph.num_nodes
-            source_hash = encode_fn(graph.edge_index[:, 0], graph.edge_index[:, 1], graph.edge_index[:, 2])
-            target_hash = encode_fn(h_index_remove, r_index_remove, t_index_remove)
-            mask = ~torch.isin(source_hash, target_hash)
+            edge_id = graph.find_edges(h_index_remove, t_index_remove, r_index_remove)
+        mask = torch.ones(len(graph.edge_index), dtype=torch.bool, device=edge_id.device)
+        mask[edge_id] = False
 
         batched_data.update({'graph_mask': mask})
         return batched_data
@@ -121,16 +285,14 @@ class KnowformerLightningModule(pl.LightningModule):
     def compute_loss(self, score, batched_data):
         # Extract indices for positive and negative samples
         positive_index = batched_data['positive_index']
-        negative_index = batched_data['negative_index']
-        all_index = torch.cat([positive_index, negative_index], 1)
         
-        filter_mask = batched_data['filter_mask'].bool()
         # print(batched_data)
         edge_type = batched_data['r_index']  
         target_edge_types = torch.tensor([2, 3], device=edge_type.device) 
         enhanced_weight = 3 
 
         if self.hparams.loss_fn == 'bce':
+            all_index = torch.cat([positive_index, batched_data['negative_index']], 1)
             logits = torch.gather(score, 1, all_index)
             target = torch.zeros_like(logits)
             target[:, 0] = 1
@@ -156,15 +318,23 @@ class KnowformerLightningModule(pl.LightningModule):
         return loss
     
     def training_step(self, batched_data):
+        batched_data = self.add_graph(batched_data, 'train')
         batch_size = batched_data['h_index'].size(0)
         num_nodes = batched_data['graph'].num_nodes
         
         batched_data['positive_index'] = batched_data['t_index'].unsqueeze(1)
-        batched_data['negative_index'] = negative_sample(batched_data['filter_mask'].bool(), 
-                                                         min(num_nodes, 2**self.hparams.num_negative_sample))
+        if self.hparams.loss_fn == 'bce':
+            # the ce loss is over all entities and needs no negatives
+            negative_index = negative_sample(get_filter_index(batched_data), batch_size, num_nodes,
+                                             min(num_nodes, 2**self.hparams.num_negative_sample))
+            if self.negative_cache is not None:
+                negative_index = self.negative_cache.fill(batched_data, negative_index)
+            batched_data['negative_index'] = negative_index
         
         score = self.model(self.remove_edge(batched_data))
         loss = self.compute_loss(score, batched_data)
+        if self.hparams.loss_fn == 'bce' and self.negative_cache is not None:
+            self.negative_cache.update(batched_data, negative_index, score.detach().gather(1, negative_index))
         
         self.log('memory', torch.cuda.max_memory_allocated()/(1024**3), prog_bar=True)
 
@@ -172,67 +342,39 @@ class KnowformerLightningModule(pl.LightningModule):
 
 
     def validation_step(self, batched_data, batch_idx):
-        score = self.model(batched_data)
-        
-        answer_score = score.gather(1, batched_data['t_index'].unsqueeze(1))
-        filter_mask = batched_data['filter_mask'].bool()
-        ranks = torch.sum((score >= answer_score) & (~filter_mask), dim=1) + 1
-
-        self.mr_metric_fn.update(ranks)
-        self.mrr_metric_fn.update(ranks)
-        self.hits1_metric_fn.update(ranks)
-        self.hits3_metric_fn.update(ranks)
-        self.hits10_metric_fn.update(ranks)
+        batched_data = self.add_graph(batched_data, 'valid')
+        ranks = self.evaluate_ranks(batched_data)
+        self.ranking_metrics.update(ranks, batched_data['r_index'])
 
     def on_validation_epoch_end(self):
-        mr = self.mr_metric_fn.compute()
-        mrr = self.mrr_metric_fn.compute()
-        hits1 = self.hits1_metric_fn.compute()
-        hits3 = self.hits3_metric_fn.compute()
-        hits10 = self.hits10_metric_fn.compute()
-
-        self.mr_metric_fn.reset()
-        self.mrr_metric_fn.reset()
-        self.hits1_metric_fn.reset()
-        self.hits3_metric_fn.reset()
-        self.hits10_metric_fn.reset()
-
-        self.log('valid_mr', mr, prog_bar=True, sync_dist=True)
-        self.log('valid_mrr', mrr, prog_bar=True, sync_dist=True)
-        self.log('valid_hits1', hits1, prog_bar=True, sync_dist=True)
-        self.log('valid_hits3', hits3, prog_bar=False, sync_dist=True)
-        self.log('valid_hits10', hits10, prog_bar=True, sync_dist=True)
+        self.log_ranking_metrics('valid', prog_bar=('mr', 'mrr', 'hits1', 'hits10'))
         
     def test_step(self, batched_data, batch_idx):
-        score = self.model(batched_data)
-        answer_score = score.gather(1, batched_data['t_index'].unsqueeze(1))
-        filter_mask = batched_data['filter_mask'].bool()
-        ranks = torch.sum((score >= answer_score) & (~filter_mask), dim=1) + 1
-        
-        self.mr_metric_fn.update(ranks)
-        self.mrr_metric_fn.update(ranks)
-        self.hits1_metric_fn.update(ranks)
-        self.hits3_metric_fn.update(ranks)
-        self.hits10_metric_fn.update(ranks)
+        batched_data = self.add_graph(batched_data, 'test')
+        ranks = self.evaluate_ranks(batched_data)
+        self.ranking_metrics.update(ranks, batched_data['r_index'])
 
     def on_test_epoch_end(self):
-        mr = self.mr_metric_fn.compute()
-        mrr = self.mrr_metric_fn.compute()
-        hits1 = self.hits1_metric_fn.compute()
-        hits3 = self.hits3_metric_fn.compute()
-        hits10 = self.hits10_metric_fn.compute()
-
-        self.mr_metric_fn.reset()
-        self.mrr_metric_fn.reset()
-        self.hits1_metric_fn.reset()
-        self.hits3_metric_fn.reset()
-        self.hits10_metric_fn.reset()
-
-        self.log('test_mr', mr, prog_bar=False, sync_dist=True)
-        self.log('test_mrr', mrr, prog_bar=True, sync_dist=True)
-        self.log('test_hits1', hits1, prog_bar=False, sync_dist=True)
-        self.log('test_hits3', hits3, prog_bar=False, sync_dist=True)
-        self.log('test_hits10', hits10, prog_bar=False, sync_dist=True)
+        self.log_ranking_metrics('test', prog_bar=('mrr',))
+    
+    def evaluate_ranks(self, batched_data):
+        if self.hparams.eval_chunk_size > 0:
+            # score eval_chunk_size entities at a time instead of all of them at once
+            state = self.model.encode(batched_data)
+            return chunked_filtered_rank(partial(self.model.score, state), batched_data['graph'].num_nodes,
+                                         batched_data['t_index'], get_filter_index(batched_data),
+                                         self.hparams.eval_chunk_size)
+        score = self.model(batched_data)
+        return filtered_rank(score, batched_data['t_index'], get_filter_index(batched_data))
+    
+    def log_ranking_metrics(self, split, prog_bar=()):
+        # the metric state is synced across processes once, so the logged values need no sync_dist;
+        # the per relation metrics are only kept in relation_metrics, not logged
+        metrics, self.relation_metrics[split] = self.ranking_metrics.compute_with_relations()
+        self.ranking_metrics.reset()
+        
+        for name, value in metrics.items():
+            self.log(f'{split}_{name}', value, prog_bar=name in prog_bar)
     
     def configure_optimizers(self):
         no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
@@ -267,6 +409,17 @@ def add_data_specific_args(parent_args):
     parser.add_argument('--num_workers', default=8, type=int)
     parser.add_argument('--batch_size', default=16, type=int)
     parser.add_argument('--test_batch_size', default=16, type=int)
+    parser.add_argument('--filter_format', default='sparse', type=str, choices=['sparse', 'dense'],
+                        help="ship known answers as (query, tail) index pairs or as a batch x num_nodes mask")
+    parser.add_argument('--no_cache', action='store_true', help="always parse the raw dataset files instead of the preprocessed cache")
+    parser.add_argument('--storage', default='memory', type=str, choices=['memory', 'mmap'],
+                        help="keep triplets and filters as int64 tensors in RAM or as int32 tensors mapped from the cache")
+    parser.add_argument('--group_by_relation', action='store_true', 
+                        help="batch training and validation queries by relation, so relation projections are shared in a batch")
+    parser.add_argument('--subgraph_hops', default=0, type=int,
+                        help="train on the k-hop neighbourhood of the batch heads instead of the whole graph, 0 disables it")
+    parser.add_argument('--subgraph_budget', default=0, type=int,
+                        help="maximum number of neighbourhood nodes sampled per head with --subgraph_hops, 0 for no limit")
     return parent_args
 
 def add_model_specific_args(parent_args):
@@ -284,6 +437,21 @@ def add_model_specific_args(parent_args):
     parser.add_argument('--learning_rate', type=float, default=1e-4, help="the initial learning rate")
     parser.add_argument('--weight_decay', type=float, default=1e-4, help="the weight decay of optimizer")
     parser.add_argument('--adversarial_temperature', type=float, default=1.0)
+    parser.add_argument('--hard_negative_cache', type=int, default=0,
+                        help="with the bce loss, reuse this many of the highest scoring negatives of the previous visit "
+                             "of every training query, 0 samples all negatives uniformly")
+    parser.add_argument('--rspmm_backend', type=str, default='vectorized', choices=BACKENDS,
+                        help="implementation of generalized_rspmm, cpp compiles src/rspmm/source/rspmm.cpp on first use")
+    parser.add_argument('--num_bases', type=int, default=0,
+                        help="decompose the relation projections into this many shared bases, 0 uses a full projection per relation")
+    parser.add_argument('--node_budget', type=int, default=0,
+                        help="propagate only over at most this many nodes explored from the head of each query, 0 uses the whole graph")
+    parser.add_argument('--activation_checkpoint', type=str, default='none', choices=CHECKPOINT_MODES,
+                        help="recompute the activations of every layer or every qk / v sub-layer in backward to save memory")
+    parser.add_argument('--eval_chunk_size', type=int, default=0,
+                        help="rank validation and test answers over chunks of this many entities to bound memory, 0 scores all at once")
+    parser.add_argument('--compile', action='store_true',
+                        help="torch.compile every layer, the first steps of each input shape pay the compilation")
     return parent_args
 
 def positive_sample(mask):
@@ -292,12 +460,123 @@ def positive_sample(mask):
     pos = torch.multinomial(p, num_samples=1)
     return pos
 
-def negative_sample(mask, num_negative_sample):
-    p = torch.ones_like(mask).float()
-    p = p * (~mask)
-    neg = torch.multinomial(p, num_samples=num_negative_sample, replacement=True)
+def distributed_seed():
+    # the seed of pl.seed_everything, the orders of all processes must agree for their shards to be disjoint
+    return int(os.environ.get('PL_GLOBAL_SEED', 0))
+
+
+def eval_shard(num_queries, num_replicas, rank):
+    """
+    The queries of rank among num_replicas processes, all of them (None) in a single process. Unlike
+    DistributedSampler, no query is repeated to even out the shards, so that every query is ranked once.
+    """
+    if num_replicas == 1:
+        return None
+    return torch.arange(rank, num_queries, num_replicas)
+
+
+def get_filter_index(batched_data):
+    # (2, nnz) pairs of (query position in batch, known tail), whichever filter format the batch uses
+    if 'filter_index' in batched_data:
+        return batched_data['filter_index']
+    return batched_data['filter_mask'].nonzero().t()
+
+def is_known(filter_hash, query_hash):
+    # filter_hash is sorted, so every query is a binary search
+    if len(filter_hash) == 0:
+        return torch.zeros_like(query_hash, dtype=torch.bool)
+    pos = torch.searchsorted(filter_hash, query_hash).clamp_(max=len(filter_hash) - 1)
+    return filter_hash[pos] == query_hash
+
+def negative_sample(filter_index, batch_size, num_nodes, num_negative_sample):
+    # uniform over the entities that are not known answers, drawn with replacement by rejection, so the cost
+    # depends on the number of negatives and not on num_nodes
+    # filter_index must be sorted by (query, tail), as given by FilterIndex.lookup or filter_mask.nonzero()
+    filter_hash = filter_index[0] * num_nodes + filter_index[1]
+    if (torch.bincount(filter_index[0], minlength=batch_size) >= num_nodes).any():
+        raise ValueError("Every entity is a known answer of some query, no negative can be sampled")
+    
+    neg = torch.randint(num_nodes, (batch_size, num_negative_sample), device=filter_index.device)
+    row = torch.arange(batch_size, device=filter_index.device).unsqueeze(-1).expand_as(neg)
+    reject = is_known(filter_hash, row * num_nodes + neg).nonzero(as_tuple=True)
+    while len(reject[0]) > 0:
+        # only the rejected draws are redrawn and checked again
+        neg[reject] = torch.randint(num_nodes, (len(reject[0]),), device=filter_index.device)
+        known = is_known(filter_hash, reject[0] * num_nodes + neg[reject])
+        reject = (reject[0][known], reject[1][known])
     return neg
 
+class HardNegativeCache:
+    """
+    The cache_size highest scoring negatives of the last visit of every training query (h, r), as global entity
+    ids. They are reused as part of the negatives of the next visit, where the self-adversarial weights of the
+    bce loss focus on them. The known answers of a training query do not change, so cached negatives stay valid.
+    """
+    def __init__(self, cache_size, num_relation):
+        self.cache_size = cache_size
+        self.num_relation = num_relation
+        self.cache = dict()
+    
+    def keys(self, batched_data):
+        h_index = batched_data['h_index']
+        if 'node_index' in batched_data:
+            # subgraph batches are relabeled, see sample_subgraph
+            h_index = batched_data['node_index'][h_index]
+        return (h_index * self.num_relation + batched_data['r_index']).tolist()
+    
+    def fill(self, batched_data, negative_index):
+        """Replaces the first negatives of every query by its cached ones."""
+        cached = torch.full((len(negative_index), self.cache_size), -1, dtype=torch.long)
+        for i, key in enumerate(self.keys(batched_data)):
+            if key in self.cache:
+                cached[i, :len(self.cache[key])] = self.cache[key]
+        cached = cached.to(negative_index.device)
+        if 'node_index' in batched_data:
+            # cached entities outside of the subgraph are not used
+            node_index = batched_data['node_index']
+            local = torch.searchsorted(node_index, cached).clamp_(max=len(node_index) - 1)
+            cached = torch.where(node_index[local] == cached, local, -1)
+        
+        k = min(self.cache_size, negative_index.size(1))
+        negative_index = negative_index.clone()
+        negative_index[:, :k] = torch.where(cached[:, :k] >= 0, cached[:, :k], negative_index[:, :k])
+        return negative_index
+    
+    def update(self, batched_data, negative_index, negative_score):
+        top = negative_score.topk(min(self.cache_size, negative_score.size(1)), dim=1).indices
+        negative_index = negative_index.gather(1, top)
+        if 'node_index' in batched_data:
+            negative_index = batched_data['node_index'][negative_index]
+        for key, negative in zip(self.keys(batched_data), negative_index.cpu()):
+            self.cache[key] = negative.unique()
+
+def filtered_rank(score, t_index, filter_index):
+    # rank among all entities, minus the known answers scored at least as high (which include the answer itself)
+    answer_score = score.gather(1, t_index.unsqueeze(1))
+    row, col = filter_index
+    ranks = torch.sum(score >= answer_score, dim=1)
+    ranks = ranks.index_add(0, row, -(score[row, col] >= answer_score[row, 0]).long())
+    return ranks + 1
+
+def chunked_filtered_rank(score_fn, num_nodes, t_index, filter_index, chunk_size):
+    # filtered_rank from the scores of chunk_size entities at a time, score_fn(entity) gives the (batch, k) scores
+    # of a slice of entities or of a (batch, k) tensor of entities per query
+    answer_score = score_fn(t_index.unsqueeze(1))
+    # the known answers grouped by entity, so the ones of a chunk are a contiguous range
+    row, col = filter_index
+    order = col.argsort()
+    row, col = row[order], col[order]
+    
+    ranks = torch.zeros_like(t_index)
+    for start in range(0, num_nodes, chunk_size):
+        end = min(start + chunk_size, num_nodes)
+        score = score_fn(slice(start, end))
+        ranks += torch.sum(score >= answer_score, dim=1)
+        lo, hi = torch.searchsorted(col, torch.tensor([start, end], device=col.device)).tolist()
+        chunk_row, chunk_col = row[lo:hi], col[lo:hi] - start
+        ranks.index_add_(0, chunk_row, -(score[chunk_row, chunk_col] >= answer_score[chunk_row, 0]).long())
+    return ranks + 1
+
 # The below functions are from huggingface transformers
 
 def _get_polynomial_decay_schedule_with_warmup_lr_lambda(
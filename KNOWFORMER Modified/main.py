@@ -6,6 +6,7 @@ from argparse import ArgumentParser
 import torch
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
+from pytorch_lightning.strategies import DDPStrategy
 from pytorch_lightning.loggers.wandb import WandbLogger
 
 from lightning import (
@@ -51,14 +52,26 @@ def train(args):
             data_path=args.data_path, 
             num_workers=args.num_workers, 
             batch_size=args.batch_size, 
-            test_batch_size=args.test_batch_size
+            test_batch_size=args.test_batch_size,
+            filter_format=args.filter_format,
+            use_cache=not args.no_cache,
+            storage=args.storage,
+            group_by_relation=args.group_by_relation,
+            subgraph_hops=args.subgraph_hops,
+            subgraph_budget=args.subgraph_budget
         )
     else:
         datamodule = TransductiveDataModule(
             data_path=args.data_path, 
             num_workers=args.num_workers, 
             batch_size=args.batch_size, 
-            test_batch_size=args.test_batch_size
+            test_batch_size=args.test_batch_size,
+            filter_format=args.filter_format,
+            use_cache=not args.no_cache,
+            storage=args.storage,
+            group_by_relation=args.group_by_relation,
+            subgraph_hops=args.subgraph_hops,
+            subgraph_budget=args.subgraph_budget
         )
         
     model = KnowformerLightningModule(
@@ -76,6 +89,13 @@ def train(args):
         learning_rate=args.learning_rate, 
         weight_decay=args.weight_decay,
         adversarial_temperature=args.adversarial_temperature,
+        rspmm_backend=args.rspmm_backend,
+        num_bases=args.num_bases,
+        node_budget=args.node_budget,
+        activation_checkpoint=args.activation_checkpoint,
+        compile=args.compile,
+        hard_negative_cache=args.hard_negative_cache,
+        eval_chunk_size=args.eval_chunk_size,
     )
 
     args.checkpoint_save_path = args.checkpoint_save_path + f'/{time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime())}'
@@ -110,17 +130,26 @@ def train(args):
 
     wandb_logger = None 
     
+    # the datamodule gives every process its own shard of the queries, see TransductiveDataModule.setup.
+    # Lightning 2.0 renamed replace_sampler_ddp to use_distributed_sampler
+    sampler_flag = 'use_distributed_sampler' if int(pl.__version__.split('.')[0]) >= 2 else 'replace_sampler_ddp'
+    strategy = args.strategy
+    if strategy == 'ddp':
+        # some layer parameters are never used, the same ones every step. static_graph lets DDP skip them
+        # instead of searching the autograd graph of every step as find_unused_parameters does
+        strategy = DDPStrategy(static_graph=True)
     trainer = pl.Trainer(
         accelerator=args.accelerator,
-        precision=args.precision,
-        strategy=args.strategy,
+        precision=int(args.precision) if args.precision.isdigit() else args.precision,
+        strategy=strategy,
         devices=args.devices,
         max_epochs=args.max_epochs,
         callbacks=[checkpoint_callback, early_stop_callback],
         logger=wandb_logger,
         num_sanity_val_steps=1,
         check_val_every_n_epoch=1,
-        gradient_clip_val=1.0
+        gradient_clip_val=1.0,
+        **{sampler_flag: False}
     )
 
     trainer.fit(model, datamodule=datamodule, ckpt_path=args.resume_checkpoint_path)
@@ -131,8 +160,9 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     # Add trainer specific arguments
     parser.add_argument('--accelerator', type=str, default='cpu')
-    parser.add_argument('--precision', type=int, default=32)
-    parser.add_argument('--strategy', type=str, default=None)
+    parser.add_argument('--precision', type=str, default='32', help='32, 64, 16 or bf16 (bf16-mixed / bf16-true on newer Lightning)')
+    parser.add_argument('--strategy', type=str, default=None, 
+                        help='e.g. ddp with --accelerator cpu --devices 4 for data parallel training over gloo')
     parser.add_argument('--devices', type=str, default='1')
     parser.add_argument('--max_epochs', type=int, default=20)
     # Add model and data specific arguments
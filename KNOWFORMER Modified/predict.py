@@ -6,6 +6,22 @@ from argparse import ArgumentParser
 import pytorch_lightning as pl
 from lightning import KnowformerLightningModule, TransductiveDataModule
 
+TEST_SET = ["MCP4725EV",
+            "MAX7219CWG+T",
+            "MCP9700DM-PCTL",
+            "ADXL203CE",
+            "D3172MMA7455L",
+            "TMP117MAIDRVR",
+            "WM8960CGEFL/RV",
+            "TB6612FNG,C,8,EL",
+            "TDA2030H",
+            "MCP2515DM-PTPLS",
+            "SHT40I-AD1B-R2",
+            "TMF8801-DB",
+            "DRV8301DCA",
+            "LM358DR2G",
+            "PAM8403DR"]
+
 def load_graph(json_path):
     with open(json_path, 'r') as f:
         graph = json.load(f)
@@ -16,11 +32,15 @@ def get_node_name(test_set, n):
         return "Test"
     return "NA"
 
-def get_edge_name(edges, h, t):
+def build_edge_index(edges):
+    # (source, target) -> relationship of the first edge between them
+    edge_index = {}
     for edge in edges:
-        if edge['source'] == h and edge['target'] == t:
-            return edge['relationship']
-    return "No"
+        edge_index.setdefault((edge['source'], edge['target']), edge['relationship'])
+    return edge_index
+
+def get_edge_name(edge_index, h, t):
+    return edge_index.get((h, t), "No")
 
 def load_triplets(file_path):
     with open(file_path, 'r') as f:
@@ -56,6 +76,27 @@ def mrr(ranks):
 def mr(ranks):
     return sum(ranks) / len(ranks)
 
+def iterate_batches(queries, batch_size):
+    for start in range(0, len(queries), batch_size):
+        yield queries[start:start + batch_size]
+
+@torch.no_grad()
+def predict_topk(model, data_object, queries, top_k, batch_size, candidate_mask_fn=None):
+    """
+    Scores (h, r, t) id queries batch_size at a time and yields (batch, scores, values, indices) per batch,
+    where values / indices are the top_k candidates among those allowed by candidate_mask_fn(batch).
+    Disallowed candidates get a score of -inf.
+    """
+    for batch in iterate_batches(queries, batch_size):
+        batch_data = data_object.test_collate_fn(batch)
+        # batches do not carry the graph, it is not part of the collated data
+        batch_data['graph'] = data_object.test_graph
+        scores = model.model(batch_data)
+        if candidate_mask_fn is not None:
+            scores = scores.masked_fill(~candidate_mask_fn(batch), float('-inf'))
+        values, indices = torch.topk(scores, k=min(top_k, scores.shape[1]), dim=1)
+        yield batch, scores, values, indices
+
 def print_rankings(triplets, predictions, component_types):
     for triplet in triplets:
         source, relation, target = triplet
@@ -82,6 +123,7 @@ def predict(args):
         batch_size=hparams['batch_size'],
         test_batch_size=hparams['test_batch_size']
     )
+    datamodule.setup('predict')
     
     
     model = KnowformerLightningModule.load_from_checkpoint(
@@ -99,70 +141,61 @@ def predict(args):
         optimizer=hparams['optimizer'],
         learning_rate=hparams['learning_rate'],
         weight_decay=hparams['weight_decay'],
-        adversarial_temperature=hparams['adversarial_temperature']
+        adversarial_temperature=hparams['adversarial_temperature'],
+        rspmm_backend=hparams.get('rspmm_backend', 'vectorized'),
+        num_bases=hparams.get('num_bases', 0),
+        node_budget=hparams.get('node_budget', 0),
+        activation_checkpoint=hparams.get('activation_checkpoint', 'none'),
+        compile=hparams.get('compile', False)
     )
     model.eval()
+    data_object = datamodule.data_object
     
-    ranks = []
-    for triplet in triplets:
-        h, r, t = triplet
-        h_id = datamodule.data_object.entity2id[h]
-        r_id = datamodule.data_object.relation2id[r]
-        t_id = datamodule.data_object.entity2id[t] if t else None
-        
-        query = torch.tensor([h_id, r_id, -1 if t_id is None else t_id])
-        batch = [query]
+    edge_index = build_edge_index(edges)
+    # candidates of a query must have the component type of its tail, and the tail is the only
+    # candidate allowed among the compatible_with neighbours of the head
+    type_ids = {}
+    entity_type = torch.tensor([type_ids.setdefault(component_types.get(data_object.id2entity[i]), len(type_ids))
+                                for i in range(data_object.num_entity)])
+    compatible = {}
+    for (source, target), relationship in edge_index.items():
+        if relationship == 'compatible_with' and target in data_object.entity2id:
+            compatible.setdefault(source, []).append(data_object.entity2id[target])
     
-        batch_data = datamodule.data_object.test_collate_fn(batch)
-
-        with torch.no_grad():
-            scores = model.model(batch_data)
-        
-        top_k = min(args.top_k, scores.shape[1])
-        top_k = scores.shape[1]
-        values, indices = torch.topk(scores[0], k=top_k)
-        
-        print(f"\nPredictions for: {h} {r} ?")
-        print("\nTop", top_k, "predictions:")
-        print("-" * 80)
-        print("Entity                  Score       Edge Relationship       Component Type      Test Set Presence")
-        print("-" * 80)
-
-        test_set = ["MCP4725EV",
-                    "MAX7219CWG+T",
-                    "MCP9700DM-PCTL",
-                    "ADXL203CE",
-                    "D3172MMA7455L",
-                    "TMP117MAIDRVR",
-                    "WM8960CGEFL/RV",
-                    "TB6612FNG,C,8,EL",
-                    "TDA2030H",
-                    "MCP2515DM-PTPLS",
-                    "SHT40I-AD1B-R2",
-                    "TMF8801-DB",
-                    "DRV8301DCA",
-                    "LM358DR2G",
-                    "PAM8403DR"]
-        cnt = 1
-        for score, idx in zip(values, indices):
-            entity = datamodule.data_object.id2entity[idx.item()]
-            edge_name = get_edge_name(edges, h, entity)
-            if edge_name == 'compatible_with':
-                if entity != t:
-                    continue
-                rank = cnt
-            if component_types.get(entity) != component_types.get(t):
-                continue
-            component_type = component_types.get(entity, "Unknown")
-            test_presence = get_node_name(test_set, entity)
-            print(f"{entity:<20} {score.item():>10.4f}       {edge_name:<20} {component_type}    {test_presence}")
-            cnt += 1
+    def candidate_mask_fn(batch):
+        h_index, _, t_index = batch.unbind(-1)
+        mask = entity_type.unsqueeze(0) == entity_type[t_index].unsqueeze(1)
+        for i, h in enumerate(h_index.tolist()):
+            mask[i, compatible.get(data_object.id2entity[h], [])] = False
+        mask[torch.arange(len(batch)), t_index] = True
+        return mask
+    
+    queries = torch.tensor([[data_object.entity2id[h], data_object.relation2id[r], data_object.entity2id[t]]
+                            for h, r, t in triplets])
+    batch_size = args.batch_size or hparams['test_batch_size']
+    
+    ranks = []
+    for batch, scores, values, indices in predict_topk(model, data_object, queries, args.top_k, batch_size, 
+                                                       candidate_mask_fn):
+        t_index = batch[:, 2]
+        t_score = scores.gather(1, t_index.unsqueeze(1))
+        ranks += (1 + (scores > t_score).sum(1)).tolist()
         
-        ranks.append(rank)
-        if t_id is not None:
-            t_score = scores[0, t_id]
-            edge_name = get_edge_name(edges, h, t)
-            component_type = component_types.get(t, "Unknown")
+        for (h_id, r_id, _), query_values, query_indices in zip(batch.tolist(), values, indices):
+            h, r = data_object.id2entity[h_id], data_object.id2relation[r_id]
+            print(f"\nPredictions for: {h} {r} ?")
+            print("\nTop", len(query_values), "predictions:")
+            print("-" * 80)
+            print("Entity                  Score       Edge Relationship       Component Type      Test Set Presence")
+            print("-" * 80)
+            for score, idx in zip(query_values.tolist(), query_indices.tolist()):
+                if score == float('-inf'):
+                    break
+                entity = data_object.id2entity[idx]
+                edge_name = get_edge_name(edge_index, h, entity)
+                component_type = component_types.get(entity, "Unknown")
+                test_presence = get_node_name(TEST_SET, entity)
+                print(f"{entity:<20} {score:>10.4f}       {edge_name:<20} {component_type}    {test_presence}")
 
     print(f"Hits@1: {hits(ranks, 1)}")
     print(f"Hits@3: {hits(ranks, 3)}")
@@ -181,6 +214,8 @@ if __name__ == "__main__":
                         help='Path to the JSON file containing the graph edges')
     parser.add_argument('--top_k', type=int, default=5,
                         help='Number of top predictions to show')
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help='Number of queries scored per forward pass, defaults to test_batch_size of the checkpoint')
     parser.add_argument('--num_workers', type=int, default=0,
                         help='Number of workers for data loading')
     args = parser.parse_args()
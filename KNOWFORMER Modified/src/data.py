@@ -1,11 +1,272 @@
 import os
-import random
-import pickle
+import copy
+import hashlib
 import itertools
-from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from functools import cached_property, partial
 
+import numpy as np
 import torch
+from torch.utils.data import Dataset, Sampler
+
+# bump when the content of the preprocessed cache changes
+CACHE_VERSION = 2
+
+# number of lines parsed at once by read_triplets
+READ_CHUNK_LINES = 2 ** 16
+
+
+def read_vocab(file_name):
+    vocab = dict()
+    with open(file_name, 'r', encoding='utf-8') as fread:
+        for line in fread:
+            name, index = line.strip().split('\t')
+            vocab[name] = int(index)
+    return vocab
+
+
+def pack_vocab(vocab):
+    # a single string unpickles much faster than a dict with one entry per entity
+    return {'names': '\n'.join(vocab.keys()), 'ids': torch.tensor(list(vocab.values()), dtype=torch.long)}
+
+
+def reverse_relations(relation2id):
+    """id of relation '-' + r for every relation id r, -1 if r has no reverse relation"""
+    reverse = np.full(max(relation2id.values(), default=-1) + 1, -1, dtype=np.int32)
+    for name, rid in relation2id.items():
+        if '-' + name in relation2id:
+            reverse[rid] = relation2id['-' + name]
+    return reverse
+
+
+def count_lines(file_name):
+    count = 0
+    last = b'\n'
+    with open(file_name, 'rb') as fread:
+        for block in iter(lambda: fread.read(2 ** 24), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    # a last line without trailing newline
+    return count + (last != b'\n')
+
+
+def read_triplets(file_name, entity2id, relation2id, chunk_lines=READ_CHUNK_LINES):
+    """
+    Reads a tab separated (head, relation, tail) file in chunks of lines and encodes it into an
+    int32 tensor of shape (2 * num_triplets, 3), where each triplet (h, r, t) is followed by its
+    reverse (t, '-' + r, h). Only one chunk of raw strings is held in memory at a time.
+    """
+    reverse = reverse_relations(relation2id)
+    
+    triplets = np.empty((count_lines(file_name), 2, 3), dtype=np.int32)
+    start = 0
+    with open(file_name, 'r', encoding='utf-8') as fread:
+        while True:
+            lines = list(itertools.islice(fread, chunk_lines))
+            if not lines:
+                break
+            num = len(lines)
+            # one split over the whole chunk is much faster than splitting every line
+            fields = ''.join(lines).replace('\n', '\t').split('\t')
+            # the newline ending the chunk leaves an empty last field
+            if lines[-1].endswith('\n'):
+                fields.pop()
+            if len(fields) != 3 * num:
+                raise ValueError('%s is not a file of tab separated triplets' % file_name)
+            heads, relations, tails = fields[0::3], fields[1::3], fields[2::3]
+            # strip the line ends, as read_vocab does
+            h = np.fromiter(map(entity2id.__getitem__, map(str.lstrip, heads)), dtype=np.int32, count=num)
+            r = np.fromiter(map(relation2id.__getitem__, relations), dtype=np.int32, count=num)
+            t = np.fromiter(map(entity2id.__getitem__, map(str.rstrip, tails)), dtype=np.int32, count=num)
+            rev_r = reverse[r]
+            if (rev_r < 0).any():
+                raise KeyError('-' + relations[(rev_r < 0).argmax()])
+            triplets[start:start + num, 0] = np.stack([h, r, t], 1)
+            triplets[start:start + num, 1] = np.stack([t, rev_r, h], 1)
+            start += num
+    return torch.from_numpy(triplets[:start]).view(-1, 3)
+
+
+def unpack_vocab(packed):
+    if not packed['names']:
+        return dict()
+    return dict(zip(packed['names'].split('\n'), packed['ids'].tolist()))
+
+
+def cast_id_arrays(data, dtype):
+    """Casts the entity / relation id arrays (triplets, filter tails, vocabulary ids) of preprocessed data."""
+    for key, value in data.items():
+        if isinstance(value, dict):
+            cast_id_arrays(value, dtype)
+        elif isinstance(value, torch.Tensor) and key.endswith(('triplets', 'values', 'ids')):
+            data[key] = value.to(dtype)
+    return data
+
+
+def file_digest(files):
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    for file_name in files:
+        with open(file_name, 'rb') as fread:
+            for block in iter(lambda: fread.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_or_preprocess(preprocess_fn, files, prefix, use_cache=True):
+    """
+    Returns preprocess_fn(), a dict of tensors and vocabularies. The result is saved next to the raw files,
+    keyed by a hash of their content, and memory-mapped instead of recomputed on later loads.
+    """
+    if not use_cache:
+        return cast_id_arrays(preprocess_fn(), torch.int)
+    
+    cache_dir = os.path.join(os.path.dirname(files[0]), 'cache')
+    cache_file = os.path.join(cache_dir, '%s-%s.pt' % (prefix, file_digest(files)))
+    if os.path.exists(cache_file):
+        return torch.load(cache_file, mmap=True, weights_only=True)
+    
+    # ids are stored as int32, which halves the cache and the memory-mapped footprint
+    data = cast_id_arrays(preprocess_fn(), torch.int)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent readers never see a partial cache
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    torch.save(data, tmp_file)
+    os.replace(tmp_file, cache_file)
+    return data
+
+
+def expand_runs(start, count):
+    """the positions start[i], ..., start[i] + count[i] - 1 of all runs, concatenated"""
+    offset = torch.arange(int(count.sum()), device=start.device)
+    offset -= torch.repeat_interleave(count.cumsum(0) - count, count)
+    return torch.repeat_interleave(start, count) + offset
+
+
+@dataclass
+class CSR:
+    """
+    Edges sorted by (target, source), the order generalized_rspmm reduces them in.
+    The incoming edges of node v are edge_index[:, row_ptr[v]:row_ptr[v + 1]].
+    If given, the outgoing edges of node u are edge_index[:, csc_order[col_ptr[u]:col_ptr[u + 1]]].
+    """
+    row_ptr: torch.Tensor
+    edge_index: torch.Tensor
+    edge_type: torch.Tensor
+    edge_weight: torch.Tensor
+    edge_order: torch.Tensor
+    col_ptr: torch.Tensor = None
+    csc_order: torch.Tensor = None
+    
+    def masked(self, mask):
+        # mask is given in the order of Graph.edge_index, the kept edges stay sorted
+        keep = mask[self.edge_order]
+        position = torch.cat([keep.new_zeros(1, dtype=torch.long), keep.cumsum(0)])
+        row_ptr = position[self.row_ptr]
+        col_ptr = csc_order = None
+        if self.col_ptr is not None:
+            keep_csc = keep[self.csc_order]
+            col_ptr = torch.cat([keep_csc.new_zeros(1, dtype=torch.long), keep_csc.cumsum(0)])[self.col_ptr]
+            csc_order = position[self.csc_order[keep_csc]]
+        return CSR(row_ptr, self.edge_index[:, keep], self.edge_type[keep], self.edge_weight[keep], self.edge_order[keep],
+                   col_ptr, csc_order)
+    
+    def subgraph(self, node_mask):
+        """the edges between the nodes of node_mask, relabeled to 0..node_mask.sum()-1 and still sorted"""
+        node_in, node_out = self.edge_index
+        keep = node_mask[node_in] & node_mask[node_out]
+        relabel = node_mask.long().cumsum(0) - 1
+        edge_index = relabel[self.edge_index[:, keep]]
+        num_nodes = int(node_mask.sum())
+        row_ptr = torch.zeros(num_nodes + 1, dtype=torch.long, device=node_mask.device)
+        row_ptr[1:] = torch.bincount(edge_index[1], minlength=num_nodes).cumsum(0)
+        return CSR(row_ptr, edge_index, self.edge_type[keep], self.edge_weight[keep], self.edge_order[keep])
+    
+    def induced(self, node_index):
+        """
+        The edges between the sorted nodes node_index, relabeled to 0..len(node_index)-1 and still sorted, with
+        the csc index. Only the incoming edges of node_index are read, so the cost grows with their degrees and
+        not with the size of the graph.
+        """
+        num_nodes = len(node_index)
+        start = self.row_ptr[node_index]
+        count = self.row_ptr[node_index + 1] - start
+        position = expand_runs(start, count)
+        node_out = torch.repeat_interleave(torch.arange(num_nodes, device=node_index.device), count)
+        source = self.edge_index[0, position]
+        node_in = torch.searchsorted(node_index, source).clamp_(max=num_nodes - 1)
+        keep = node_index[node_in] == source
+        position, node_in, node_out = position[keep], node_in[keep], node_out[keep]
+        
+        row_ptr = torch.zeros(num_nodes + 1, dtype=torch.long, device=node_index.device)
+        row_ptr[1:] = torch.bincount(node_out, minlength=num_nodes).cumsum(0)
+        csc_order = node_in.argsort(stable=True)
+        col_ptr = torch.zeros(num_nodes + 1, dtype=torch.long, device=node_index.device)
+        col_ptr[1:] = torch.bincount(node_in, minlength=num_nodes).cumsum(0)
+        return CSR(row_ptr, torch.stack([node_in, node_out]), self.edge_type[position], self.edge_weight[position],
+                   self.edge_order[position], col_ptr, csc_order)
+    
+    def out_neighbors(self, query, node):
+        """(query, target) of every outgoing edge of the (query, node) pairs, needs the csc index"""
+        start = self.col_ptr[node]
+        count = self.col_ptr[node + 1] - start
+        position = self.csc_order[expand_runs(start, count)]
+        return torch.repeat_interleave(query, count), self.edge_index[1, position]
+    
+    def explore(self, h_index, num_hop, node_budget=0):
+        """The nodes visited by explore_pairs as a batch x num_nodes bool mask."""
+        query, node = self.explore_pairs(h_index, num_hop, node_budget)
+        visited = torch.zeros(h_index.size(0), len(self.row_ptr) - 1, dtype=torch.bool, device=h_index.device)
+        visited[query, node] = True
+        return visited
+    
+    def explore_pairs(self, h_index, num_hop, node_budget=0):
+        """
+        Breadth-first search of num_hop hops from every query head over the outgoing edges, needs the csc index.
+        Each query visits at most node_budget nodes (all if 0), among the new nodes of a hop those reached by
+        the most edges are kept first. Returns the visited (query, node) pairs, sorted. The visited pairs are
+        kept as sorted keys, so the memory grows with the explored neighbourhoods and not with num_nodes.
+        """
+        batch_size = h_index.size(0)
+        num_nodes = len(self.row_ptr) - 1
+        node_budget = node_budget or num_nodes
+        query = torch.arange(batch_size, device=h_index.device)
+        visited = (query * num_nodes + h_index).sort().values
+        num_visited = torch.ones(batch_size, dtype=torch.long, device=h_index.device)
+        node = h_index
+        for _ in range(num_hop):
+            query, node = self.out_neighbors(query, node)
+            key, count = torch.unique(query * num_nodes + node, return_counts=True)
+            found = torch.searchsorted(visited, key).clamp_(max=len(visited) - 1)
+            new = visited[found] != key
+            key, count = key[new], count[new]
+            if len(key) == 0:
+                break
+            query, node = key // num_nodes, key % num_nodes
+            
+            # rank the new nodes of every query by their number of incoming frontier edges
+            order = torch.argsort(query * (count.max() + 1) - count, stable=True)
+            query, node = query[order], node[order]
+            query_count = torch.bincount(query, minlength=batch_size)
+            rank = torch.arange(len(query), device=query.device) - (query_count.cumsum(0) - query_count)[query]
+            keep = rank < (node_budget - num_visited)[query]
+            query, node = query[keep], node[keep]
+            
+            visited = torch.cat([visited, query * num_nodes + node]).sort().values
+            num_visited += torch.bincount(query, minlength=batch_size)
+        return visited // num_nodes, visited % num_nodes
+    
+    def to(self, device):
+        # a copy, the CPU index stays usable, e.g. by DataLoader workers
+        csr = copy.copy(self)
+        csr.row_ptr = self.row_ptr.to(device)
+        csr.edge_index = self.edge_index.to(device)
+        csr.edge_type = self.edge_type.to(device)
+        csr.edge_weight = self.edge_weight.to(device)
+        csr.edge_order = self.edge_order.to(device)
+        if self.col_ptr is not None:
+            csr.col_ptr = self.col_ptr.to(device)
+            csr.csc_order = self.csc_order.to(device)
+        return csr
 
 
 @dataclass
@@ -13,291 +274,522 @@ class Graph:
     edge_index: torch.Tensor
     num_nodes: int
     num_relations: int
+    # the csr of edge_index if it is already known, e.g. for the subgraphs of sample_subgraph
+    csr: CSR = field(default=None, repr=False, compare=False)
+    
+    def __post_init__(self):
+        # edge_index never changes, so sort it for message passing only once
+        if self.csr is None:
+            self.csr = self.build_csr()
+        # sorted key of every edge of csr, the (head, tail) pair encoded as tail * num_nodes + head, which fits
+        # in int64 for any graph whose ids fit in int32 (the relation is not part of the key, see find_edges)
+        self.edge_key = self.csr.edge_index[1] * self.num_nodes + self.csr.edge_index[0]
+    
+    def build_csr(self):
+        head, relation, tail = self.edge_index.long().t()
+        edge_order = (tail * self.num_nodes + head).argsort(stable=True)
+        row_ptr = torch.zeros(self.num_nodes + 1, dtype=torch.long)
+        row_ptr[1:] = torch.bincount(tail, minlength=self.num_nodes).cumsum(0)
+        edge_weight = torch.ones(len(edge_order))
+        # the outgoing edges of every node, used to explore the neighbourhood of the query heads
+        head = head[edge_order]
+        csc_order = head.argsort(stable=True)
+        col_ptr = torch.zeros(self.num_nodes + 1, dtype=torch.long)
+        col_ptr[1:] = torch.bincount(head, minlength=self.num_nodes).cumsum(0)
+        return CSR(row_ptr, torch.stack([head, tail[edge_order]]), relation[edge_order], edge_weight, edge_order,
+                   col_ptr, csc_order)
+    
+    def find_edges(self, head, tail, relation=None):
+        """
+        Ids (rows of edge_index) of all edges from head[i] to tail[i], only those of type relation[i] if given.
+        The edges of a (head, tail) pair are a contiguous run of the csr, found by binary search in edge_key,
+        so the cost is O(len(head) log |E|) plus the number of edges found.
+        """
+        key = tail * self.num_nodes + head
+        start = torch.searchsorted(self.edge_key, key)
+        count = torch.searchsorted(self.edge_key, key, right=True) - start
+        position = expand_runs(start, count)
+        if relation is not None:
+            position = position[self.csr.edge_type[position] == torch.repeat_interleave(relation, count)]
+        return self.csr.edge_order[position]
     
     def to(self, device):
-        self.edge_index = self.edge_index.to(device)
-        return self
+        # a copy, as CSR.to
+        graph = copy.copy(self)
+        graph.edge_index = self.edge_index.to(device)
+        graph.csr = self.csr.to(device)
+        graph.edge_key = self.edge_key.to(device)
+        return graph
+
+
+class FilterIndex:
+    """
+    Known tails of every (h, r) query stored as CSR. The tails of key = h * num_relation + r are
+    values[ptr[i]:ptr[i + 1]] where keys[i] == key, keys and the tails of each key are sorted.
+    """
+    def __init__(self, keys, ptr, values, num_relation):
+        self.keys = keys
+        self.ptr = ptr
+        self.values = values
+        self.num_relation = num_relation
+    
+    @classmethod
+    def from_triplets(cls, triplets, num_relation):
+        triplets = triplets.long()
+        pairs = torch.stack([triplets[:, 0] * num_relation + triplets[:, 1], triplets[:, 2]], 1)
+        pairs = torch.unique(pairs, dim=0)
+        keys, counts = torch.unique_consecutive(pairs[:, 0], return_counts=True)
+        ptr = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        return cls(keys, ptr, pairs[:, 1].contiguous(), num_relation)
+    
+    def state_dict(self):
+        return {'keys': self.keys, 'ptr': self.ptr, 'values': self.values, 'num_relation': self.num_relation}
+    
+    def lookup(self, h_index, r_index):
+        """Returns a (2, nnz) tensor of (query position in batch, known tail) pairs."""
+        if len(self.keys) == 0:
+            return torch.zeros(2, 0, dtype=torch.long)
+        key = h_index * self.num_relation + r_index
+        pos = torch.searchsorted(self.keys, key).clamp(max=len(self.keys) - 1)
+        found = self.keys[pos] == key
+        start = self.ptr[pos]
+        count = (self.ptr[pos + 1] - start) * found
+        
+        row = torch.repeat_interleave(torch.arange(len(key)), count)
+        offset = torch.arange(len(row)) - torch.repeat_interleave(count.cumsum(0) - count, count)
+        col = self.values[torch.repeat_interleave(start, count) + offset].long()
+        return torch.stack([row, col])
+    
+    def mask(self, h_index, r_index, num_nodes):
+        row, col = self.lookup(h_index, r_index)
+        mask = torch.zeros(len(h_index), num_nodes, dtype=torch.bool)
+        mask[row, col] = True
+        return mask
+    
+    def to_batch(self, h_index, r_index, num_nodes, filter_format='dense'):
+        if filter_format == 'sparse':
+            return {'filter_index': self.lookup(h_index, r_index)}
+        return {'filter_mask': self.mask(h_index, r_index, num_nodes)}
+
+
+def stack_triplets(batch):
+    # (batch, 3) long tensor of a list of triplets, or of a slice given by TripletDataset.__getitems__
+    if not isinstance(batch, torch.Tensor):
+        batch = torch.stack(list(batch), 0)
+    return batch.long()
+
+
+class TripletDataset(Dataset):
+    """
+    The rows index of triplets, all of them if index is None. With __getitems__, the DataLoader fetches
+    a batch as one slice of triplets instead of one row at a time.
+    """
+    def __init__(self, triplets, index=None):
+        self.triplets = triplets
+        self.index = index
+    
+    def __len__(self):
+        return len(self.triplets) if self.index is None else len(self.index)
+    
+    def __getitem__(self, i):
+        return self.triplets[i if self.index is None else self.index[i]]
+    
+    def __getitems__(self, indices):
+        indices = torch.as_tensor(indices)
+        return self.triplets[indices if self.index is None else self.index[indices]]
+    
+    @property
+    def relations(self):
+        return self.triplets[:, 1] if self.index is None else self.triplets[self.index, 1]
+
+
+class RelationGroupedBatchSampler(Sampler):
+    """
+    Batches of dataset indices whose queries share the same relation, so that the relation projections of
+    the model are computed for few unique relations per batch. With shuffle, indices are shuffled within
+    every relation and batches are shuffled across relations, each epoch.
+    With num_replicas > 1, every process draws the same batches from seed and the epoch (see set_epoch), as
+    torch.utils.data.DistributedSampler, and keeps every num_replicas-th of them from rank on. The first
+    batches are repeated so that all processes get the same number of batches.
+    """
+    def __init__(self, relations, batch_size, shuffle=False, drop_last=False, generator=None,
+                 num_replicas=1, rank=0, seed=0):
+        self.relations = torch.as_tensor(relations).long()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+    
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        
+    def __iter__(self):
+        generator = self.generator
+        if self.shuffle and generator is None:
+            generator = torch.Generator()
+            if self.num_replicas > 1:
+                generator.manual_seed(self.seed + self.epoch)
+            else:
+                # the same seeding as torch.utils.data.RandomSampler
+                generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        
+        if self.shuffle:
+            order = torch.randperm(len(self.relations), generator=generator)
+        else:
+            order = torch.arange(len(self.relations))
+        # a stable sort groups indices by relation and keeps their order within a relation
+        relations, perm = self.relations[order].sort(stable=True)
+        order = order[perm]
+        counts = torch.unique_consecutive(relations, return_counts=True)[1]
+        
+        batches = []
+        for group in order.split(counts.tolist()):
+            group_batches = list(group.split(self.batch_size))
+            if self.drop_last and len(group_batches[-1]) < self.batch_size:
+                group_batches.pop()
+            batches += group_batches
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            padding = len(self) * self.num_replicas - len(batches)
+            batches = (batches + [batches[i % len(batches)] for i in range(padding)])[self.rank::self.num_replicas]
+        for batch in batches:
+            yield batch.tolist()
+    
+    def __len__(self):
+        counts = torch.unique(self.relations, return_counts=True)[1]
+        if self.drop_last:
+            num_batches = int((counts // self.batch_size).sum())
+        else:
+            num_batches = int(((counts + self.batch_size - 1) // self.batch_size).sum())
+        # the batches of one process
+        return -(-num_batches // self.num_replicas)
+
+
+def sample_subgraph(batched_data, graph, num_hop, node_budget=0):
+    """
+    Restricts a batch of queries on graph to the subgraph induced by the num_hop neighbourhoods of its heads
+    (at most node_budget nodes per head, all if 0) and its tails. Nodes are relabeled to 0..n-1, the global id
+    of subgraph node i is node_index[i]. The subgraph is added to the batch as batched_data['graph'].
+    The subgraph is gathered from the csr of graph, so the cost grows with the neighbourhoods and not with graph.
+    """
+    h_index, t_index = batched_data['h_index'], batched_data['t_index']
+    
+    _, node = graph.csr.explore_pairs(h_index, num_hop, node_budget)
+    node_index = torch.unique(torch.cat([node, t_index]))
+    relabel = lambda index: torch.searchsorted(node_index, index.contiguous())
+    
+    # the edges of csr are the rows of the subgraph edge_index, in the same order
+    csr = graph.csr.induced(node_index)
+    csr = replace(csr, edge_order=torch.arange(len(csr.edge_type)))
+    edge_index = torch.stack([csr.edge_index[0], csr.edge_type, csr.edge_index[1]], 1)
+    
+    batched_data = dict(batched_data, h_index=relabel(h_index), t_index=relabel(t_index), node_index=node_index,
+                        graph=Graph(edge_index, len(node_index), graph.num_relations, csr))
+    if 'filter_index' in batched_data:
+        row, col = batched_data['filter_index']
+        local = relabel(col).clamp_(max=len(node_index) - 1)
+        keep = node_index[local] == col
+        batched_data['filter_index'] = torch.stack([row[keep], local[keep]])
+    if 'filter_mask' in batched_data:
+        batched_data['filter_mask'] = batched_data['filter_mask'][:, node_index]
+    return batched_data
+
+
+def subgraph_collate_fn(batch, collate_fn, graph, num_hop, node_budget=0):
+    return sample_subgraph(collate_fn(batch), graph, num_hop, node_budget)
 
 
 class TransductiveKnowledgeGraph:
-    def __init__(self, data_path):
+    def __init__(self, data_path, filter_format='dense', use_cache=True, storage='memory', seed=0):
         self.data_path = data_path
-        
-        self.entity2id = dict()
-        self.id2entity = dict()
-        self.relation2id = dict()
-        self.id2relation = dict()
-        
-        with open(os.path.join(self.data_path, 'entities.txt'), 'r', encoding='utf-8') as fread:
-            for line in fread:
-                entity, eid = line.strip().split('\t')
-                self.entity2id[entity] = int(eid)
-                self.id2entity[int(eid)] = entity
-                
-        with open(os.path.join(self.data_path, 'relations.txt'), 'r', encoding='utf-8') as fread:
-            for line in fread:
-                relation, rid = line.strip().split('\t')
-                self.relation2id[relation] = int(rid)
-                self.id2relation[int(rid)] = relation
+        # 'dense': batch x num_nodes bool filter_mask, 'sparse': (2, nnz) filter_index of (query, tail) pairs
+        self.filter_format = filter_format
+        # 'memory': int64 tensors in RAM, 'mmap': int32 tensors backed by the cache file, shared by all
+        # processes that load it (e.g. DataLoader workers) instead of copied into each of them
+        self.storage = storage
+        if self.storage == 'mmap' and not use_cache:
+            raise ValueError("storage='mmap' maps the preprocessed cache, it cannot be used without it")
+        
+        data = self.load_data(self.data_path, use_cache)
+        if self.storage == 'memory':
+            data = cast_id_arrays(data, torch.long)
+        
+        # the vocabularies are only unpacked into dicts when they are used
+        self.packed_vocab = {'entity2id': data['entity2id'], 'relation2id': data['relation2id']}
                 
-        self.num_entity = len(self.entity2id)
-        self.num_relation = len(self.relation2id)
-        
-        raw_train_triplets = self.read_triplets(os.path.join(self.data_path, 'train.txt'))
-        raw_valid_triplets = self.read_triplets(os.path.join(self.data_path, 'valid.txt'))
-        raw_test_triplets = self.read_triplets(os.path.join(self.data_path, 'test.txt'))
-        
-        # Shuffle raw training triplets before encoding
-        random.shuffle(raw_train_triplets)
-        
-        self.train_triplets = self.encode_triplets(raw_train_triplets)
-        self.valid_triplets = self.encode_triplets(raw_valid_triplets)
-        self.test_triplets = self.encode_triplets(raw_test_triplets)
+        self.num_entity = len(data['entity2id']['ids'])
+        self.num_relation = len(data['relation2id']['ids'])
+        
+        if self.storage == 'mmap':
+            # shuffling would copy the triplets out of the cache, the training order comes from the DataLoader
+            self.train_triplets = data['train_triplets']
+        else:
+            # the order only depends on seed, so that all processes of a distributed run agree on it
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            # Shuffle raw training triplets before encoding. The cache stores the forward and reverse
+            # edge of every raw triplet next to each other, so shuffling pairs of rows is the same
+            train_triplets = data['train_triplets'].view(-1, 2, 3)
+            train_triplets = train_triplets[torch.randperm(len(train_triplets), generator=generator)].view(-1, 3)
+            
+            # Shuffle encoded training triplets again for more randomization
+            self.train_triplets = train_triplets[torch.randperm(len(train_triplets), generator=generator)]
+        # training queries use the forward relations, train_collate_fn adds their inverse
+        self.train_query_index = (self.train_triplets[:, 1] % 2 == 0).nonzero().squeeze(-1)
+        self.valid_triplets = data['valid_triplets']
+        self.test_triplets = data['test_triplets']
+        
+        self.train_answers = FilterIndex(**data['train_answers'])
+        self.valid_answers = FilterIndex(**data['valid_answers'])
+        self.test_answers = FilterIndex(**data['test_answers'])
+        
+        self.train_filters = FilterIndex(**data['train_filters'])
+        self.valid_filters = FilterIndex(**data['valid_filters'])
+        self.test_filters = FilterIndex(**data['test_filters'])
+    
+        self.edge_index = self.train_triplets.clone() if self.storage == 'memory' else self.train_triplets
         
-        # Shuffle encoded training triplets again for more randomization
-        random.shuffle(self.train_triplets)
+        # all splits propagate over the training edges, so they share one graph and its CSR
+        self.train_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
+        self.valid_graph = self.train_graph
+        self.test_graph = self.train_graph
+    
+    @cached_property
+    def entity2id(self):
+        return unpack_vocab(self.packed_vocab['entity2id'])
+    
+    @cached_property
+    def id2entity(self):
+        return {eid: entity for entity, eid in self.entity2id.items()}
+    
+    @cached_property
+    def relation2id(self):
+        return unpack_vocab(self.packed_vocab['relation2id'])
+    
+    @cached_property
+    def id2relation(self):
+        return {rid: relation for relation, rid in self.relation2id.items()}
+    
+    @classmethod
+    def load_data(cls, data_path, use_cache=True):
+        """The preprocessed dataset of data_path, read from the cache or preprocessed and written to it."""
+        files = [os.path.join(data_path, name) for name in 
+                 ['entities.txt', 'relations.txt', 'train.txt', 'valid.txt', 'test.txt']]
+        return load_or_preprocess(partial(cls.preprocess, data_path), files, 'transductive', use_cache)
+    
+    @staticmethod
+    def preprocess(data_path):
+        entity2id = read_vocab(os.path.join(data_path, 'entities.txt'))
+        relation2id = read_vocab(os.path.join(data_path, 'relations.txt'))
+        num_relation = len(relation2id)
         
-        self.train_filters = self.get_filters(self.train_triplets)
-        self.valid_filters = self.get_filters(self.train_triplets + self.valid_triplets + self.test_triplets)
-        self.test_filters = self.get_filters(self.train_triplets + self.valid_triplets + self.test_triplets)
+        train_triplets = read_triplets(os.path.join(data_path, 'train.txt'), entity2id, relation2id)
+        valid_triplets = read_triplets(os.path.join(data_path, 'valid.txt'), entity2id, relation2id)
+        test_triplets = read_triplets(os.path.join(data_path, 'test.txt'), entity2id, relation2id)
         
-        self.train_answers = self.get_filters(self.train_triplets)
-        self.valid_answers = self.get_filters(self.valid_triplets)
-        self.test_answers = self.get_filters(self.test_triplets)
+        train_filters = FilterIndex.from_triplets(train_triplets, num_relation).state_dict()
+        all_filters = FilterIndex.from_triplets(torch.cat([train_triplets, valid_triplets, test_triplets]), 
+                                                num_relation).state_dict()
         
-        self.train_triplets = torch.tensor(self.train_triplets)
-        self.valid_triplets = torch.tensor(self.valid_triplets)
-        self.test_triplets = torch.tensor(self.test_triplets)
+        return {
+            'entity2id': pack_vocab(entity2id),
+            'relation2id': pack_vocab(relation2id),
+            'train_triplets': train_triplets,
+            'valid_triplets': valid_triplets,
+            'test_triplets': test_triplets,
+            'train_answers': train_filters,
+            'valid_answers': FilterIndex.from_triplets(valid_triplets, num_relation).state_dict(),
+            'test_answers': FilterIndex.from_triplets(test_triplets, num_relation).state_dict(),
+            'train_filters': train_filters,
+            'valid_filters': all_filters,
+            'test_filters': all_filters,
+        }
     
-        self.edge_index = self.train_triplets.clone()
-        
-        self.train_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
-        self.valid_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
-        self.test_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
-    
-    def read_triplets(self, file_name):
-        triplets = list()
-        with open(file_name, 'r', encoding='utf-8') as fread:
-            for line in fread:
-                h, r, t = line.strip().split('\t')
-                triplets.append((h, r, t))
-        return triplets
-    
-    def encode_triplets(self, raw_triplets):
-        encoded_triplets = list()
-        for triplet in raw_triplets:
-            h, r, t = self.entity2id[triplet[0]], self.relation2id[triplet[1]], self.entity2id[triplet[2]]
-            rev_r = self.relation2id['-' + triplet[1]]
-            encoded_triplets.append((h, r, t))
-            encoded_triplets.append((t, rev_r, h))
-        return encoded_triplets
-    
-    def get_filters(self, triplets):
-        filters = defaultdict(set)
-        for h, r, t in triplets:
-            filters[(h, r)].add(t)
-        return filters
-
     def train_collate_fn(self, batch):
-        batch_size = len(batch)
-        for i in range(batch_size//2, batch_size):
-            batch[i] = torch.flip(batch[i], [0])
-            batch[i][1] = torch.where(batch[i][1]%2==0, batch[i][1] + 1, batch[i][1] - 1)
-        
-        filter_mask = torch.zeros(batch_size, self.train_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.train_filters[(query[0].item(), query[1].item())])] = 1
-
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+        triplets = stack_triplets(batch)
+        # the second half of the batch becomes inverse queries (t, r ^ 1, h), relation 2k + 1 is the inverse of 2k
+        half = len(triplets) // 2
+        inverse = triplets[half:].flip(-1)
+        inverse[:, 1] ^= 1
+        h_index, r_index, t_index = torch.cat([triplets[:half], inverse]).unbind(-1)
         
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.train_graph,
+            **self.train_filters.to_batch(h_index, r_index, self.train_graph.num_nodes, self.filter_format),
         }
     
     def valid_collate_fn(self, batch):
-        batch_size = len(batch)
-        
-        filter_mask = torch.zeros(batch_size, self.valid_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.valid_filters[(query[0].item(), query[1].item())])] = 1
-        
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+        h_index, r_index, t_index = stack_triplets(batch).unbind(-1)
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.valid_graph
+            **self.valid_filters.to_batch(h_index, r_index, self.valid_graph.num_nodes, self.filter_format)
         }
     
     def test_collate_fn(self, batch):
-        batch_size = len(batch)
-        
-        filter_mask = torch.zeros(batch_size, self.test_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.test_filters[(query[0].item(), query[1].item())])] = 1
-        
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+        h_index, r_index, t_index = stack_triplets(batch).unbind(-1)
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.test_graph
+            **self.test_filters.to_batch(h_index, r_index, self.test_graph.num_nodes, self.filter_format)
         }    
         
 
 class InductiveKnowledgeGraph:
-    def __init__(self, data_path):
+    def __init__(self, data_path, filter_format='dense', use_cache=True, storage='memory'):
         self.data_path = data_path
+        # 'dense': batch x num_nodes bool filter_mask, 'sparse': (2, nnz) filter_index of (query, tail) pairs
+        self.filter_format = filter_format
+        # 'memory': int64 tensors in RAM, 'mmap': int32 tensors backed by the cache file, shared by all
+        # processes that load it (e.g. DataLoader workers) instead of copied into each of them
+        self.storage = storage
+        if self.storage == 'mmap' and not use_cache:
+            raise ValueError("storage='mmap' maps the preprocessed cache, it cannot be used without it")
         self.ind_data_path = data_path + '_ind'
         
-        # train entities are disjoint of test entities
-        self.entity2id = dict()
-        self.id2entity = dict()
-        self.ind_entity2id = dict()
-        self.ind_id2entity = dict()
-        # test relations are a subset of training relations
-        self.relation2id = dict()
-        self.id2relation = dict()
-        
-        with open(os.path.join(self.data_path, 'entities.txt'), 'r', encoding='utf-8') as fread:
-            for line in fread:
-                entity, eid = line.strip().split('\t')
-                self.entity2id[entity] = int(eid)
-                self.id2entity[int(eid)] = entity
+        data = self.load_data(self.data_path, use_cache)
+        if self.storage == 'memory':
+            data = cast_id_arrays(data, torch.long)
         
-        with open(os.path.join(self.ind_data_path, 'entities.txt'), 'r', encoding='utf-8') as fread:
-            for line in fread:
-                entity, eid = line.strip().split('\t')
-                self.ind_entity2id[entity] = int(eid)
-                self.ind_id2entity[int(eid)] = entity
-        
-        with open(os.path.join(self.data_path, 'relations.txt'), 'r', encoding='utf-8') as fread:
-            for line in fread:
-                relation, rid = line.strip().split('\t')
-                self.relation2id[relation] = int(rid)
-                self.id2relation[int(rid)] = relation
+        # train entities are disjoint of test entities, test relations are a subset of training relations.
+        # the vocabularies are only unpacked into dicts when they are used
+        self.packed_vocab = {'entity2id': data['entity2id'], 'ind_entity2id': data['ind_entity2id'], 
+                             'relation2id': data['relation2id']}
                 
-        self.num_entity = len(self.entity2id)
-        self.ind_num_entity = len(self.ind_entity2id)
-        self.num_relation = len(self.relation2id)
-        
-        raw_train_triplets = self.read_triplets(os.path.join(self.data_path, 'train.txt'))
-        raw_valid_triplets = self.read_triplets(os.path.join(self.data_path, 'valid.txt'))
-        raw_test_triplets = self.read_triplets(os.path.join(self.data_path, 'test.txt'))
-        ind_raw_train_triplets = self.read_triplets(os.path.join(self.ind_data_path, 'train.txt'))
-        ind_raw_valid_triplets = self.read_triplets(os.path.join(self.ind_data_path, 'valid.txt'))
-        ind_raw_test_triplets = self.read_triplets(os.path.join(self.ind_data_path, 'test.txt'))
+        self.num_entity = len(data['entity2id']['ids'])
+        self.ind_num_entity = len(data['ind_entity2id']['ids'])
+        self.num_relation = len(data['relation2id']['ids'])
         
-        self.train_triplets = self.encode_triplets(raw_train_triplets)
-        self.valid_triplets = self.encode_triplets(raw_valid_triplets)
-        self.test_triplets = self.encode_triplets(ind_raw_test_triplets, is_ind=True)
+        self.train_triplets = data['train_triplets']
+        # training queries use the forward relations, train_collate_fn adds their inverse
+        self.train_query_index = (self.train_triplets[:, 1] % 2 == 0).nonzero().squeeze(-1)
+        self.valid_triplets = data['valid_triplets']
+        self.test_triplets = data['test_triplets']
         
         # inductive train triplets construct test graph
-        self.ind_train_triplets = self.encode_triplets(ind_raw_train_triplets, is_ind=True)
-        self.ind_valid_triplets = self.encode_triplets(ind_raw_valid_triplets, is_ind=True)
+        self.ind_train_triplets = data['ind_train_triplets']
+        self.ind_valid_triplets = data['ind_valid_triplets']
         
-        self.train_filters = self.get_filters(self.train_triplets)
-        self.valid_filters = self.get_filters(self.train_triplets + self.valid_triplets)
-        self.test_filters = self.get_filters(self.ind_train_triplets + self.ind_valid_triplets + self.test_triplets)
+        self.train_answers = FilterIndex(**data['train_answers'])
+        self.valid_answers = FilterIndex(**data['valid_answers'])
+        self.test_answers = FilterIndex(**data['test_answers'])
         
-        self.train_answers = self.get_filters(self.train_triplets)
-        self.valid_answers = self.get_filters(self.valid_triplets)
-        self.test_answers = self.get_filters(self.test_triplets)
-        
-        self.train_triplets = torch.tensor(self.train_triplets)
-        self.valid_triplets = torch.tensor(self.valid_triplets)
-        self.test_triplets = torch.tensor(self.test_triplets)
-        
-        self.ind_train_triplets = torch.tensor(self.ind_train_triplets)
+        self.train_filters = FilterIndex(**data['train_filters'])
+        self.valid_filters = FilterIndex(**data['valid_filters'])
+        self.test_filters = FilterIndex(**data['test_filters'])
     
-        self.edge_index = self.train_triplets.clone()
-        self.test_edge_index = self.ind_train_triplets.clone()
+        self.edge_index = self.train_triplets.clone() if self.storage == 'memory' else self.train_triplets
+        self.test_edge_index = self.ind_train_triplets.clone() if self.storage == 'memory' else self.ind_train_triplets
         
+        # training and validation propagate over the same edges, so they share one graph and its CSR
         self.train_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
-        self.valid_graph = Graph(self.edge_index, self.num_entity, self.num_relation)
+        self.valid_graph = self.train_graph
         self.test_graph = Graph(self.test_edge_index, self.ind_num_entity, self.num_relation)
+    
+    @cached_property
+    def entity2id(self):
+        return unpack_vocab(self.packed_vocab['entity2id'])
+    
+    @cached_property
+    def id2entity(self):
+        return {eid: entity for entity, eid in self.entity2id.items()}
+    
+    @cached_property
+    def ind_entity2id(self):
+        return unpack_vocab(self.packed_vocab['ind_entity2id'])
+    
+    @cached_property
+    def ind_id2entity(self):
+        return {eid: entity for entity, eid in self.ind_entity2id.items()}
+    
+    @cached_property
+    def relation2id(self):
+        return unpack_vocab(self.packed_vocab['relation2id'])
+    
+    @cached_property
+    def id2relation(self):
+        return {rid: relation for relation, rid in self.relation2id.items()}
+    
+    @classmethod
+    def load_data(cls, data_path, use_cache=True):
+        """The preprocessed dataset of data_path, read from the cache or preprocessed and written to it."""
+        files = [os.path.join(path, name) for path in [data_path, data_path + '_ind'] for name in
+                 ['entities.txt', 'relations.txt', 'train.txt', 'valid.txt', 'test.txt']]
+        return load_or_preprocess(partial(cls.preprocess, data_path), files, 'inductive', use_cache)
+    
+    @staticmethod
+    def preprocess(data_path):
+        ind_data_path = data_path + '_ind'
+        entity2id = read_vocab(os.path.join(data_path, 'entities.txt'))
+        ind_entity2id = read_vocab(os.path.join(ind_data_path, 'entities.txt'))
+        relation2id = read_vocab(os.path.join(data_path, 'relations.txt'))
+        num_relation = len(relation2id)
+        
+        train_triplets = read_triplets(os.path.join(data_path, 'train.txt'), entity2id, relation2id)
+        valid_triplets = read_triplets(os.path.join(data_path, 'valid.txt'), entity2id, relation2id)
+        test_triplets = read_triplets(os.path.join(ind_data_path, 'test.txt'), ind_entity2id, relation2id)
+        ind_train_triplets = read_triplets(os.path.join(ind_data_path, 'train.txt'), ind_entity2id, relation2id)
+        ind_valid_triplets = read_triplets(os.path.join(ind_data_path, 'valid.txt'), ind_entity2id, relation2id)
+        
+        train_filters = FilterIndex.from_triplets(train_triplets, num_relation).state_dict()
         
-    def read_triplets(self, file_name):
-        triplets = list()
-        with open(file_name, 'r', encoding='utf-8') as fread:
-            for line in fread:
-                h, r, t = line.strip().split('\t')
-                triplets.append((h, r, t))
-        return triplets
-    
-    def encode_triplets(self, raw_triplets, is_ind=False):
-        encoded_triplets = list()
-        for triplet in raw_triplets:
-            if is_ind:
-                h, r, t = self.ind_entity2id[triplet[0]], self.relation2id[triplet[1]], self.ind_entity2id[triplet[2]]
-                rev_r = self.relation2id['-' + triplet[1]]
-            else:
-                h, r, t = self.entity2id[triplet[0]], self.relation2id[triplet[1]], self.entity2id[triplet[2]]
-                rev_r = self.relation2id['-' + triplet[1]]
-            encoded_triplets.append((h, r, t))
-            encoded_triplets.append((t, rev_r, h))
-        return encoded_triplets
-    
-    def get_filters(self, triplets):
-        filters = defaultdict(set)
-        for h, r, t in triplets:
-            filters[(h, r)].add(t)
-        return filters
-
-    def train_collate_fn(self, batch):
-        batch_size = len(batch)
-        for i in range(batch_size//2, batch_size):
-            batch[i] = torch.flip(batch[i], [0])
-            batch[i][1] = torch.where(batch[i][1]%2==0, batch[i][1] + 1, batch[i][1] - 1)
+        return {
+            'entity2id': pack_vocab(entity2id),
+            'ind_entity2id': pack_vocab(ind_entity2id),
+            'relation2id': pack_vocab(relation2id),
+            'train_triplets': train_triplets,
+            'valid_triplets': valid_triplets,
+            'test_triplets': test_triplets,
+            'ind_train_triplets': ind_train_triplets,
+            'ind_valid_triplets': ind_valid_triplets,
+            'train_answers': train_filters,
+            'valid_answers': FilterIndex.from_triplets(valid_triplets, num_relation).state_dict(),
+            'test_answers': FilterIndex.from_triplets(test_triplets, num_relation).state_dict(),
+            'train_filters': train_filters,
+            'valid_filters': FilterIndex.from_triplets(torch.cat([train_triplets, valid_triplets]), 
+                                                       num_relation).state_dict(),
+            'test_filters': FilterIndex.from_triplets(torch.cat([ind_train_triplets, ind_valid_triplets, test_triplets]), 
+                                                      num_relation).state_dict(),
+        }
         
-        filter_mask = torch.zeros(batch_size, self.train_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.train_filters[(query[0].item(), query[1].item())])] = 1
-
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+    def train_collate_fn(self, batch):
+        triplets = stack_triplets(batch)
+        # the second half of the batch becomes inverse queries (t, r ^ 1, h), relation 2k + 1 is the inverse of 2k
+        half = len(triplets) // 2
+        inverse = triplets[half:].flip(-1)
+        inverse[:, 1] ^= 1
+        h_index, r_index, t_index = torch.cat([triplets[:half], inverse]).unbind(-1)
         
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.train_graph,
+            **self.train_filters.to_batch(h_index, r_index, self.train_graph.num_nodes, self.filter_format),
         }
     
     def valid_collate_fn(self, batch):
-        batch_size = len(batch)
-        
-        filter_mask = torch.zeros(batch_size, self.valid_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.valid_filters[(query[0].item(), query[1].item())])] = 1
-        
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+        h_index, r_index, t_index = stack_triplets(batch).unbind(-1)
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.valid_graph
+            **self.valid_filters.to_batch(h_index, r_index, self.valid_graph.num_nodes, self.filter_format)
         }
     
     def test_collate_fn(self, batch):
-        batch_size = len(batch)
-        
-        filter_mask = torch.zeros(batch_size, self.test_graph.num_nodes)
-        for batch_idx, query in enumerate(batch):
-            filter_mask[batch_idx, list(self.test_filters[(query[0].item(), query[1].item())])] = 1
-        
-        h_index, r_index, t_index = torch.stack(batch, 0).unbind(-1)
+        h_index, r_index, t_index = stack_triplets(batch).unbind(-1)
         return {
             'h_index': h_index,
             'r_index': r_index,
             't_index': t_index,
-            'filter_mask': filter_mask,
-            'graph': self.test_graph
+            **self.test_filters.to_batch(h_index, r_index, self.test_graph.num_nodes, self.filter_format)
         }
\ No newline at end of file
@@ -2,81 +2,64 @@ import torch
 from torchmetrics import Metric
 
 
-class MRMetric(Metric):
+class RankingMetrics(Metric):
+    """
+    MR, MRR and Hits@k of filtered ranks, overall and per query relation, from one packed state.
+    Row r of stats holds, for the queries on relation r, the number of ranks equal to 1..max_rank, the number
+    of ranks above max_rank, the sum of ranks and the sum of reciprocal ranks. Hits@k is exact for any
+    k <= max_rank and MR / MRR are exact for all ranks. stats is the only state, so syncing across processes
+    is a single all-reduce.
+    """
     # Set to True if the metric is differentiable else set to False
-    is_differentiable: None
+    is_differentiable = False
 
     # Set to True if the metric reaches it optimal value when the metric is maximized.
     # Set to False if it when the metric is minimized.
-    higher_is_better: False
+    higher_is_better = None
 
     # Set to True if the metric during 'update' requires access to the global metric
     # state for its calculations. If not, setting this to False indicates that all
     # batch states are independent and we will optimize the runtime of 'forward'
-    full_state_update: True
+    full_state_update = False
 
-    def __init__(self):
+    def __init__(self, num_relation, ks=(1, 3, 10), max_rank=100):
         super().__init__()
-        self.add_state('rank_sum', default=torch.tensor(0.0), dist_reduce_fx='sum')
-        self.add_state('total', default=torch.tensor(0.0), dist_reduce_fx='sum')
-
-    def update(self, ranks):
-        self.total += ranks.size(0)
-        self.rank_sum += ranks.sum()
-
-    def compute(self):
-        return self.rank_sum / self.total
-    
-
-class MRRMetric(Metric):
-    # Set to True if the metric is differentiable else set to False
-    is_differentiable: None
-
-    # Set to True if the metric reaches it optimal value when the metric is maximized.
-    # Set to False if it when the metric is minimized.
-    higher_is_better: True
-
-    # Set to True if the metric during 'update' requires access to the global metric
-    # state for its calculations. If not, setting this to False indicates that all
-    # batch states are independent and we will optimize the runtime of 'forward'
-    full_state_update: True
-
-    def __init__(self):
-        super().__init__()
-        self.add_state('rank_sum', default=torch.tensor(0.0), dist_reduce_fx='sum')
-        self.add_state('total', default=torch.tensor(0.0), dist_reduce_fx='sum')
-
-    def update(self, ranks):
-        self.total += ranks.size(0)
-        self.rank_sum += (1./ ranks).sum()
-
-    def compute(self):
-        return self.rank_sum / self.total
-    
-
-class HitsMetric(Metric):
-    # Set to True if the metric is differentiable else set to False
-    is_differentiable: None
-
-    # Set to True if the metric reaches it optimal value when the metric is maximized.
-    # Set to False if it when the metric is minimized.
-    higher_is_better: True
-
-    # Set to True if the metric during 'update' requires access to the global metric
-    # state for its calculations. If not, setting this to False indicates that all
-    # batch states are independent and we will optimize the runtime of 'forward'
-    full_state_update: True
-
-    def __init__(self, topk=1):
-        super().__init__()
-        self.add_state('rank_sum', default=torch.tensor(0.0), dist_reduce_fx='sum')
-        self.add_state('total', default=torch.tensor(0.0), dist_reduce_fx='sum')
-        self.topk = topk
-
-    def update(self, ranks):
-        self.total += ranks.size(0)
-        self.rank_sum += (ranks <= self.topk).sum()
+        if max(ks) > max_rank:
+            raise ValueError("Hits@%d needs max_rank >= %d, got max_rank=%d" % (max(ks), max(ks), max_rank))
+        self.num_relation = num_relation
+        self.ks = ks
+        self.max_rank = max_rank
+        # float64 counts and sums are exact up to 2^53
+        self.add_state('stats', default=torch.zeros(num_relation, max_rank + 3, dtype=torch.float64),
+                       dist_reduce_fx='sum')
+
+    def update(self, ranks, relations):
+        num_column = self.max_rank + 3
+        bins = ranks.clamp(max=self.max_rank + 1) - 1
+        stats = self.stats.view(-1)
+        stats.index_add_(0, relations * num_column + bins, torch.ones_like(ranks, dtype=stats.dtype))
+        stats.index_add_(0, relations * num_column + self.max_rank + 1, ranks.to(stats.dtype))
+        stats.index_add_(0, relations * num_column + self.max_rank + 2, 1 / ranks.to(stats.dtype))
+
+    def _metrics(self, stats):
+        # stats: (..., max_rank + 3) -> dict of (...) tensors, nan where there is no query
+        total = stats[..., :self.max_rank + 1].sum(-1)
+        hits = stats[..., :self.max_rank].cumsum(-1)
+        metrics = {
+            'mr': stats[..., self.max_rank + 1] / total,
+            'mrr': stats[..., self.max_rank + 2] / total,
+        }
+        for k in self.ks:
+            metrics['hits%d' % k] = hits[..., k - 1] / total
+        return {name: value.float() for name, value in metrics.items()}
 
     def compute(self):
-        return self.rank_sum / self.total
-    
+        return self._metrics(self.stats.sum(0))
+
+    def compute_with_relations(self):
+        """
+        The overall metrics and those of every relation as (num_relation,) tensors, nan for relations
+        without queries, from a single sync of stats.
+        """
+        with self.sync_context():
+            return self._metrics(self.stats.sum(0)), self._metrics(self.stats)
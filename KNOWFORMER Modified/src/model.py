@@ -2,12 +2,48 @@ import math
 from copy import deepcopy
 
 import numpy as np
-import einops
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from .rspmm import generalized_rspmm
 
+# granularities of activation checkpointing
+CHECKPOINT_MODES = ('none', 'layer', 'sublayer')
+
+
+def compile_module(module, **kwargs):
+    # compile in place, so that the parameter names in the state dict do not change
+    if hasattr(module, 'compile'):
+        module.compile(**kwargs)
+    else:
+        # nn.Module.compile needs torch >= 2.2
+        module.forward = torch.compile(module.forward, **kwargs)
+
+
+def to_node_major(x):
+    # batch x node x dim -> node x (batch dim), the layout generalized_rspmm propagates over
+    return x.transpose(0, 1).flatten(1)
+
+
+def to_batch_major(x, batch_size):
+    # inverse of to_node_major
+    return x.unflatten(1, (batch_size, -1)).transpose(0, 1)
+
+
+def select_nodes(x, entity):
+    # x[:, entity] for a slice or (k,) entities shared by the batch, x[i, entity[i]] for (batch, k) entities
+    if isinstance(entity, slice) or entity.dim() == 1:
+        return x[:, entity]
+    return x.gather(1, entity.view(*entity.shape, *[1] * (x.dim() - 2)).expand(*entity.shape, *x.shape[2:]))
+
+
+def maybe_checkpoint(enabled, function, *args, **kwargs):
+    # recompute the activations of function in backward instead of keeping them
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(function, *args, use_reentrant=False, **kwargs)
+    return function(*args, **kwargs)
+
 
 class KnowformerFFN(nn.Module):
     def __init__(self, hidden_dim, drop):
@@ -27,10 +63,38 @@ class KnowformerFFN(nn.Module):
         return x
 
 
+class BasisLinear(nn.Module):
+    """
+    Drop-in for nn.Linear(in_dim, out_dim * num_relation) where the output of every relation is a mixture of
+    num_bases shared projections, so parameters grow with num_bases instead of num_relation.
+    """
+    def __init__(self, in_dim, out_dim, num_relation, num_bases):
+        super().__init__()
+        self.out_dim = out_dim
+        self.num_relation = num_relation
+        self.num_bases = num_bases
+        
+        self.basis = nn.Linear(in_dim, out_dim*num_bases)
+        self.coefficient = nn.Parameter(torch.empty(num_relation, num_bases))
+        nn.init.xavier_uniform_(self.coefficient)
+        
+    def forward(self, x):
+        basis = self.basis(x).unflatten(-1, (self.num_bases, self.out_dim))
+        return torch.matmul(self.coefficient, basis).flatten(-2)
+
+
+def relation_linear(in_dim, out_dim, num_relation, num_bases=0):
+    """Linear(in_dim, out_dim * num_relation), basis-decomposed if num_bases > 0"""
+    if num_bases > 0:
+        return BasisLinear(in_dim, out_dim, num_relation, num_bases)
+    return nn.Linear(in_dim, out_dim*num_relation)
+
+
 class KnowformerQKLayer(nn.Module):
-    def __init__(self, hidden_dim):
+    def __init__(self, hidden_dim, rspmm_backend='vectorized'):
         super().__init__()
         self.hidden_dim = hidden_dim
+        self.rspmm_backend = rspmm_backend
         
         self.mlp_out = nn.Sequential(nn.Linear(self.hidden_dim, self.hidden_dim), nn.ReLU(), 
                                      nn.Linear(self.hidden_dim, self.hidden_dim))
@@ -39,23 +103,16 @@ class KnowformerQKLayer(nn.Module):
         self.eps = torch.nn.Parameter(torch.tensor([0.0]))
         self.norm = nn.LayerNorm(self.hidden_dim)
         
-    def forward(self, x, z, graph, graph_mask):
+    def forward(self, x, z, csr):
         batch_size = x.size(0)
-        V = x.size(1)
-        R = z.size(1)
-        
-        # define some functions
-        split = lambda t: einops.rearrange(t, 'b l d -> l (b d)')
-        merge = lambda t: einops.rearrange(t, 'l (b d) -> b l d', b=batch_size)
-        
-        edge_index = graph.edge_index if graph_mask is None else graph.edge_index[graph_mask]
         
         # the rspmm cuda kernel from torchdrug 
         # https://torchdrug.ai/docs/api/layers.html#torchdrug.layers.functional.generalized_rspmm
         # reduce memory complexity from O(|E|d) to O(|V|d)
-        output = generalized_rspmm(edge_index[:, [0, 2]].transpose(0, 1), edge_index[:, 1], torch.ones_like(edge_index[:, 0]).float(),
-                                   relation=split(z.float()), input=split(x.float()))
-        output = merge(output)
+        output = generalized_rspmm(csr.edge_index, csr.edge_type, csr.edge_weight,
+                                   relation=to_node_major(z), input=to_node_major(x), backend=self.rspmm_backend,
+                                   presorted=True)
+        output = to_batch_major(output, batch_size)
         
         x_shortcut = x
         x = self.mlp_out(output + self.alpha * x)
@@ -65,13 +122,15 @@ class KnowformerQKLayer(nn.Module):
     
     
 class KnowformerVLayer(nn.Module):
-    def __init__(self, num_relation, hidden_dim):
+    def __init__(self, num_relation, hidden_dim, rspmm_backend='vectorized', num_bases=0):
         super().__init__()
         self.hidden_dim = hidden_dim
         self.num_relation = num_relation
+        self.rspmm_backend = rspmm_backend
+        self.num_bases = num_bases
         
         self.fc_pna = nn.Linear(self.hidden_dim, self.hidden_dim)
-        self.fc_z = nn.Linear(self.hidden_dim, self.hidden_dim*self.num_relation)
+        self.fc_z = relation_linear(self.hidden_dim, self.hidden_dim, self.num_relation, self.num_bases)
         self.fc_out = nn.Sequential(nn.Linear(self.hidden_dim, self.hidden_dim), nn.ReLU(), 
                                     nn.Linear(self.hidden_dim, self.hidden_dim))
         self.beta = nn.Parameter(torch.empty(1, self.hidden_dim))
@@ -82,25 +141,21 @@ class KnowformerVLayer(nn.Module):
         self.fc_readout_i = nn.Linear(self.hidden_dim, self.hidden_dim)
         self.fc_readout_o = nn.Linear(self.hidden_dim, self.hidden_dim)
         
-    def forward(self, x, z, r_index, graph, graph_mask=None):
+    def forward(self, x, z, r_index, csr, z_index=None):
         batch_size = x.size(0)
-        V = x.size(1)
         R = self.num_relation
         
-        # define some functions
-        split = lambda t: einops.rearrange(t, 'b l d -> l (b d)')
-        merge = lambda t: einops.rearrange(t, 'l (b d) -> b l d', b=batch_size)
-        
-        z = einops.rearrange(self.fc_z(z), 'b (r d) -> b r d', r=R)
-        
-        edge_index = graph.edge_index if graph_mask is None else graph.edge_index[graph_mask]
+        z = self.fc_z(z).unflatten(-1, (R, -1))
+        if z_index is not None:
+            z = z[z_index]
         
         # the rspmm cuda kernel from torchdrug 
         # https://torchdrug.ai/docs/api/layers.html#torchdrug.layers.functional.generalized_rspmm
         # reduce memory complexity from O(|E|d) to O(|V|d)
-        output = generalized_rspmm(edge_index[:, [0, 2]].transpose(0, 1), edge_index[:, 1], torch.ones_like(edge_index[:, 0]).float(),
-                                   relation=split(z.float()), input=split(x.float()))
-        output = merge(output)
+        output = generalized_rspmm(csr.edge_index, csr.edge_type, csr.edge_weight,
+                                   relation=to_node_major(z), input=to_node_major(x), backend=self.rspmm_backend,
+                                   presorted=True)
+        output = to_batch_major(output, batch_size)
 
         x_shortcut = x
         x = self.fc_out(output + self.beta * x) 
@@ -109,8 +164,92 @@ class KnowformerVLayer(nn.Module):
         return x
     
 
+def _float(x):
+    # contiguous float32 copy of reduced precision tensors, the attention denominator grows with the number of nodes
+    dtype = torch.float32 if x.dtype in (torch.bfloat16, torch.float16) else x.dtype
+    return x.to(dtype, memory_format=torch.contiguous_format)
+
+
+def _normalize(x, eps=1e-12):
+    # F.normalize, also returning the clamped norm
+    norm = torch.linalg.vector_norm(x, dim=-1, keepdim=True).clamp_min_(eps)
+    return x / norm, norm
+
+
+def _normalize_backward(grad, x_hat, norm, eps=1e-12):
+    dot = torch.linalg.vecdot(grad, x_hat).unsqueeze(-1).masked_fill_(norm <= eps, 0)
+    return (grad - x_hat * dot).div_(norm)
+
+
+class LinearAttentionFunction(torch.autograd.Function):
+    """
+    Linear attention of KnowformerLayer over q, k, v of shape (b, h, n, d). q and k are L2 normalized and
+    k is scaled by weight[b]: output = (q (k^T v) + sum_n v + n v) / (q sum_n k + 2n).
+    Only the inputs are saved for backward, the normalization and the d x d summaries are recomputed.
+    Reduced precision inputs are computed in float32, the output has the promoted type of q, k and v.
+    """
+    @staticmethod
+    def forward(ctx, q, k, v, weight):
+        ctx.save_for_backward(q, k, v, weight)
+        dtype = torch.promote_types(torch.promote_types(q.dtype, k.dtype), v.dtype)
+        # autocast would run the matmuls in reduced precision again
+        with torch.autocast(q.device.type, enabled=False):
+            return LinearAttentionFunction._forward(_float(q), _float(k), _float(v), weight).to(dtype)
+    
+    @staticmethod
+    def _forward(q, k, v, weight):
+        num_node = q.size(2)
+        weight = weight.to(q.dtype).view(-1, 1, 1, 1)
+        q_hat, _ = _normalize(q)
+        k_hat, _ = _normalize(k)
+        
+        # the weight of k is applied to the summaries, which are much smaller than k
+        kv = (k_hat.transpose(-1, -2) @ v) * weight
+        k_sum = k_hat.sum(2, keepdim=True) * weight
+        output = q_hat @ kv
+        output.add_(v, alpha=num_node)
+        output += v.sum(2, keepdim=True)
+        output /= (q_hat @ k_sum.transpose(-1, -2)).add_(2 * num_node)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # saved_tensors is unpacked once, a second unpack fails under non-reentrant activation checkpointing
+        *inputs, weight = ctx.saved_tensors
+        q, k, v = map(_float, inputs)
+        weight = weight.to(q.dtype).view(-1, 1, 1, 1)
+        num_node = q.size(2)
+        q_hat, q_norm = _normalize(q)
+        k_hat, k_norm = _normalize(k)
+        
+        kv = (k_hat.transpose(-1, -2) @ v) * weight
+        k_sum = k_hat.sum(2, keepdim=True) * weight
+        denominator = (q_hat @ k_sum.transpose(-1, -2)).add_(2 * num_node)
+        
+        # output = numerator / denominator
+        grad_numerator = _float(grad_output) / denominator
+        grad_q = grad_numerator @ kv.transpose(-1, -2)
+        # <grad_numerator, numerator> per node, without recomputing the numerator
+        grad_denominator = torch.linalg.vecdot(grad_q, q_hat) + num_node * torch.linalg.vecdot(grad_numerator, v)
+        grad_denominator = grad_denominator.unsqueeze(-1) + grad_numerator @ v.sum(2, keepdim=True).transpose(-1, -2)
+        grad_denominator = grad_denominator.div_(denominator).neg_()
+        grad_kv = q_hat.transpose(-1, -2) @ grad_numerator * weight
+        
+        grad_q.addcmul_(grad_denominator, k_sum)
+        grad_k = v @ grad_kv.transpose(-1, -2)
+        grad_k += (grad_denominator.transpose(-1, -2) @ q_hat) * weight
+        grad_v = k_hat @ grad_kv
+        grad_v.add_(grad_numerator, alpha=num_node)
+        grad_v += grad_numerator.sum(2, keepdim=True)
+        
+        grad_q = _normalize_backward(grad_q, q_hat, q_norm)
+        grad_k = _normalize_backward(grad_k, k_hat, k_norm)
+        return grad_q.to(inputs[0].dtype), grad_k.to(inputs[1].dtype), grad_v.to(inputs[2].dtype), None
+
+
 class KnowformerLayer(nn.Module):
-    def __init__(self, num_relation, num_qk_layer, num_v_layer, hidden_dim, num_heads, drop):
+    def __init__(self, num_relation, num_qk_layer, num_v_layer, hidden_dim, num_heads, drop, rspmm_backend='vectorized',
+                 num_bases=0, checkpoint_sublayer=False):
         super().__init__()
         self.num_relation = num_relation
         self.num_qk_layer = num_qk_layer
@@ -118,13 +257,16 @@ class KnowformerLayer(nn.Module):
         self.hidden_dim = hidden_dim
         self.num_heads = num_heads
         self.drop = drop
+        self.rspmm_backend = rspmm_backend
+        self.num_bases = num_bases
+        self.checkpoint_sublayer = checkpoint_sublayer
         
-        # define for getting proper device
+        # define for getting proper device, forward uses the device of its inputs and this is kept for checkpoints
         self.dummy_param = nn.Parameter(torch.zeros(1))
         
-        layer = KnowformerVLayer(self.num_relation, self.hidden_dim)
+        layer = KnowformerVLayer(self.num_relation, self.hidden_dim, self.rspmm_backend, self.num_bases)
         self.v_layers = nn.ModuleList([deepcopy(layer) for _ in range(self.num_v_layer)])
-        layer = KnowformerQKLayer(self.hidden_dim)
+        layer = KnowformerQKLayer(self.hidden_dim, self.rspmm_backend)
         self.qk_layers = nn.ModuleList([deepcopy(layer) for _ in range(self.num_qk_layer)])
         
         self.fc_qk_x = nn.Sequential(
@@ -141,7 +283,7 @@ class KnowformerLayer(nn.Module):
         self.fc_attn_value = nn.Linear(self.hidden_dim*2, self.hidden_dim)
         self.fc_to_qk = nn.Linear(self.hidden_dim, self.hidden_dim*2)
         self.fc_to_v = nn.Linear(self.hidden_dim, self.hidden_dim)
-        self.fc_qk_z = nn.Linear(self.hidden_dim, self.hidden_dim*self.num_relation)
+        self.fc_qk_z = relation_linear(self.hidden_dim, self.hidden_dim, self.num_relation, self.num_bases)
         
         self.ffn = KnowformerFFN(self.hidden_dim, self.drop)
         self.norm = nn.LayerNorm(self.hidden_dim)
@@ -152,51 +294,37 @@ class KnowformerLayer(nn.Module):
         return self.dummy_param.device
     
     def attn(self, q, k, v, r_index, return_attn=False, prototype_index=None):
-        split = lambda t: einops.rearrange(t, 'b l (h d) -> b h l d', h=self.num_heads)
-        merge = lambda t: einops.rearrange(t, 'b h l d -> b l (h d)')
-        norm = lambda t: F.normalize(t, dim=-1)
-
-        batch_size = q.size(0)
-        num_node = q.size(1)
-
-        q, k, v = map(split, [q, k, v])
-        q, k = map(norm, [q, k])
+        # b l (h d) -> b h l d
+        q, k, v = [t.unflatten(-1, (self.num_heads, -1)).transpose(1, 2) for t in (q, k, v)]
 
+        # keys are down-weighted for queries on the given relations
         added_weight = 0.333
-        specific_edge_types = torch.tensor([2, 3], device=r_index.device) 
-        additional_weights = (r_index.unsqueeze(1).eq(specific_edge_types).any(dim=1).float() * (added_weight - 1)).unsqueeze(-1)
-        additional_weights = additional_weights.unsqueeze(1).unsqueeze(-1).expand_as(v) 
-        k_weighted = k + k * additional_weights
-
-        full_rank_term = torch.eye(k.size(-1)).to(self.device)
-        full_rank_term = einops.repeat(full_rank_term, 'd D -> b h d D', b=batch_size, h=self.num_heads)
-        kvs = einops.einsum(k_weighted, v, 'b h v d, b h v D -> b h d D')
-        numerator = einops.einsum(q, kvs, 'b h v d, b h d D -> b h v D')
-        numerator = numerator + einops.reduce(v, 'b h (v w) d -> b h w d', 'sum', w=1) + v * num_node
-
-        denominator = einops.einsum(q, einops.reduce(k_weighted, 'b h v d -> b h d', 'sum'), 'b h v d, b h d -> b h v')
-        denominator = denominator + torch.full(denominator.shape, fill_value=num_node).to(self.device) + num_node
-        denominator = einops.rearrange(denominator, 'b h (v w) -> b h v w', w=1)
-
-        output = numerator / denominator
-        output = merge(output)
+        weight = ((r_index == 2) | (r_index == 3)).to(k.dtype) * (added_weight - 1) + 1
+        output = LinearAttentionFunction.apply(q, k, v, weight)
+        output = output.transpose(1, 2).flatten(2)
 
         return output
 
-    def forward(self, h_index, r_index, x, z, rev_z, graph, graph_mask, return_attn=False, prototype_index=None):
+    def forward(self, h_index, r_index, x, z, rev_z, csr, return_attn=False, prototype_index=None, z_index=None,
+                qk_noise=None):
+        # z_index: if given, z holds one row per unique query relation and z_index maps each query to its row
+        # qk_noise: the random batch x num_nodes x 1 input of the qk branch, drawn here if not given
         batch_size = x.size(0)
+        num_nodes = x.size(1)
 
-        qk_z = einops.rearrange(self.fc_qk_z(z), 'b (r d) -> b r d', r=self.num_relation)
-        qk_x = torch.zeros(batch_size, graph.num_nodes, 1).to(self.device).normal_(0, 4)
+        qk_z = self.fc_qk_z(z).unflatten(-1, (self.num_relation, -1))
+        if z_index is not None:
+            qk_z = qk_z[z_index]
+        qk_x = qk_noise if qk_noise is not None else x.new_empty(batch_size, num_nodes, 1).normal_(0, 4)
         qk_x = self.fc_qk_x(torch.cat([x, qk_x], dim=-1))
         for layer in self.qk_layers:
-            qk_x = layer(qk_x, qk_z, graph, graph_mask)
+            qk_x = maybe_checkpoint(self.checkpoint_sublayer, layer, qk_x, qk_z, csr)
             
-        v_x = torch.zeros(batch_size, graph.num_nodes, self.hidden_dim).to(self.device)
-        v_x[torch.arange(batch_size).to(self.device), h_index] = 1
+        v_x = x.new_zeros(batch_size, num_nodes, self.hidden_dim)
+        v_x[torch.arange(batch_size, device=x.device), h_index] = 1
         v_x = self.fc_v_x(torch.cat([x, v_x], dim=-1))
         for layer in self.v_layers:
-            v_x = layer(v_x, z, r_index, graph, graph_mask)
+            v_x = maybe_checkpoint(self.checkpoint_sublayer, layer, v_x, z, r_index, csr, z_index)
 
         q, k = self.fc_to_qk(qk_x).chunk(2, dim=-1)
         v = v_x 
@@ -209,7 +337,8 @@ class KnowformerLayer(nn.Module):
     
     
 class Knowformer(nn.Module):
-    def __init__(self, num_relation, num_layer, num_qk_layer, num_v_layer, hidden_dim, num_heads, drop):
+    def __init__(self, num_relation, num_layer, num_qk_layer, num_v_layer, hidden_dim, num_heads, drop, rspmm_backend='vectorized',
+                 num_bases=0, node_budget=0, activation_checkpoint='none', compile=False):
         super().__init__()
         self.num_relation = num_relation
         self.num_layer = num_layer
@@ -218,14 +347,26 @@ class Knowformer(nn.Module):
         self.hidden_dim = hidden_dim
         self.num_heads = num_heads
         self.drop = drop
+        self.rspmm_backend = rspmm_backend
+        self.num_bases = num_bases
+        # if > 0, only propagate over the (at most) node_budget nodes explored from the head of every query
+        self.node_budget = node_budget
+        # 'layer' or 'sublayer' recompute the activations of each KnowformerLayer / QK and V layer in backward
+        self.activation_checkpoint = activation_checkpoint
+        # torch.compile every KnowformerLayer, the batch preparation in forward stays eager
+        self.compile = compile
         
-        # define for getting proper device
+        # define for getting proper device, forward uses the device of its inputs and this is kept for checkpoints
         self.dummy_param = nn.Parameter(torch.zeros(1))
         
         self.query_embedding = nn.Embedding(self.num_relation, self.hidden_dim)
         
-        layer = KnowformerLayer(self.num_relation, self.num_qk_layer, self.num_v_layer, self.hidden_dim, self.num_heads, self.drop)
+        layer = KnowformerLayer(self.num_relation, self.num_qk_layer, self.num_v_layer, self.hidden_dim, self.num_heads, self.drop,
+                                self.rspmm_backend, self.num_bases, self.activation_checkpoint == 'sublayer')
         self.layers = nn.ModuleList([deepcopy(layer) for _ in range(self.num_layer)])
+        if self.compile:
+            for layer in self.layers:
+                compile_module(layer)
         
         self.mlp_out = nn.Sequential(nn.Linear(self.hidden_dim, self.hidden_dim),
                                      nn.ReLU(),
@@ -236,6 +377,13 @@ class Knowformer(nn.Module):
         return self.dummy_param.device
     
     def forward(self, bacthed_data):
+        return self.score(self.encode(bacthed_data))
+    
+    def encode(self, bacthed_data):
+        """
+        The final node states of the queries of a batch, see score. x only has the nodes of the union of the
+        explored neighbourhoods with node_budget > 0, relabel maps the graph nodes to them (-1 for the others).
+        """
         h_index, r_index, graph, graph_mask = (bacthed_data['h_index'], 
                                                bacthed_data['r_index'], 
                                                bacthed_data['graph'], 
@@ -245,18 +393,56 @@ class Knowformer(nn.Module):
         
         rev_r_index = torch.where(r_index % 2 == 1, r_index - 1, r_index + 1)
         
-        z = self.query_embedding(r_index)
+        # the relation projections only depend on the query relation, compute them once per unique relation
+        r_unique, z_index = torch.unique(r_index, return_inverse=True)
+        z = self.query_embedding(r_unique)
         rev_z = self.query_embedding(rev_r_index).unsqueeze(1)
         
-        index = einops.repeat(h_index, 'b -> b v d', v=1, d=self.hidden_dim)
-        x = torch.zeros((batch_size, graph.num_nodes, self.hidden_dim), device=self.device)
+        # remove the masked edges once per batch instead of once per message passing step
+        csr = graph.csr if graph_mask is None else graph.csr.masked(graph_mask)
         
+        num_nodes = graph.num_nodes
+        state = {'num_nodes': num_nodes}
+        if self.node_budget > 0:
+            # the V branch reaches num_layer * num_v_layer hops from the head, propagate over the union of the
+            # explored neighbourhoods only
+            visited = csr.explore(h_index, self.num_layer * self.num_v_layer, self.node_budget)
+            node_mask = visited.any(0)
+            relabel = torch.where(node_mask, node_mask.long().cumsum(0) - 1, -1)
+            state.update(visited=visited, node_mask=node_mask, relabel=relabel)
+            h_index = relabel[h_index]
+            csr = csr.subgraph(node_mask)
+            num_nodes = int(node_mask.sum())
+        
+        # the dtype of the parameters, e.g. bfloat16 for bf16-true precision
+        x = z.new_zeros(batch_size, num_nodes, self.hidden_dim)
         for layer in self.layers:
-            x = layer(h_index, r_index, x, z, rev_z, graph, graph_mask)
-
-        score = self.mlp_out(x).squeeze(-1)
+            # drawn outside of the layer, so that a checkpointed layer recomputes with the same noise
+            qk_noise = x.new_empty(batch_size, num_nodes, 1).normal_(0, 4)
+            x = maybe_checkpoint(self.activation_checkpoint == 'layer', layer, h_index, r_index, x, z, rev_z, csr, 
+                                 z_index=z_index, qk_noise=qk_noise)
+        state['x'] = x
+        return state
+    
+    def score(self, state, entity=None):
+        """
+        Scores of the queries encoded by encode for all entities if entity is None, (batch, num_nodes), or for
+        a slice or (k,) tensor of entities shared by the batch or a (batch, k) tensor of entities per query,
+        (batch, k). Only the states of the requested entities go through mlp_out.
+        """
+        x = state['x']
+        if self.node_budget == 0:
+            return self.mlp_out(x if entity is None else select_nodes(x, entity)).squeeze(-1)
         
-        return score
+        # nodes a query did not explore get the score of an empty node state
+        default = self.mlp_out(x.new_zeros(self.hidden_dim))
+        if entity is None:
+            full_score = default.expand(x.size(0), state['num_nodes']).clone()
+            full_score[:, state['node_mask']] = self.mlp_out(x).squeeze(-1)
+            return torch.where(state['visited'], full_score, default)
+        # the nodes explored by a query are in x
+        score = self.mlp_out(select_nodes(x, state['relabel'][entity].clamp(min=0))).squeeze(-1)
+        return torch.where(select_nodes(state['visited'], entity), score, default)
     
 
 def create_projection_matrix(m, d, seed=0, scaling=0, struct_mode=False):
@@ -1 +1 @@
-from .rspmm import generalized_rspmm
+from .rspmm import generalized_rspmm, set_backend, get_backend, BACKENDS
@@ -1,6 +1,53 @@
+import os
+import warnings
+from typing import Tuple
+
 import torch
 from torch import autograd
 
+# available implementations of generalized_rspmm, the first one is the default
+BACKENDS = ('vectorized', 'cpp', 'loop')
+_backend = BACKENDS[0]
+
+# the compiled CPU extension, loaded on first use of the cpp backend
+_cpp_extension = None
+_cpp_extension_error = None
+
+# number of message elements (edges x features) materialized at once by the vectorized backend
+CHUNK_NUMEL = 2 ** 24
+
+
+def set_backend(backend):
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown rspmm backend `%s`. Available backends are %s" % (backend, BACKENDS))
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def load_cpp_extension():
+    """
+    JIT-compile the CPU half of source/rspmm.cpp. The built library is cached by torch under
+    TORCH_EXTENSIONS_DIR (~/.cache/torch_extensions by default), so only the first run compiles.
+    Returns None if the extension cannot be built.
+    """
+    global _cpp_extension, _cpp_extension_error
+    if _cpp_extension is None and _cpp_extension_error is None:
+        try:
+            from torch.utils import cpp_extension
+            path = os.path.join(os.path.dirname(__file__), "source")
+            _cpp_extension = cpp_extension.load("rspmm", [os.path.join(path, "rspmm.cpp")],
+                                                extra_cflags=["-Ofast"])
+        except Exception as e:
+            _cpp_extension_error = e
+            warnings.warn("Failed to build the rspmm C++ extension, falling back to the vectorized "
+                          "backend. Error: %s" % e)
+    return _cpp_extension
+
+
 class RSPMMFunction(autograd.Function):
     @staticmethod
     def forward(ctx, edge_index, edge_type, edge_weight, relation, input, sum_type="add", mul_type="mul"):
@@ -71,20 +118,253 @@ class RSPMMFunction(autograd.Function):
         # edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type
         return None, None, grad_weight, grad_relation, grad_input, None, None
 
-def generalized_rspmm(edge_index, edge_type, edge_weight, relation, input, sum="add", mul="mul"):
+
+def _edge_chunks(num_edge, dim):
+    chunk_size = max(1, CHUNK_NUMEL // max(1, dim))
+    for start in range(0, num_edge, chunk_size):
+        yield start, min(start + chunk_size, num_edge)
+
+
+def _message(edge_index, edge_type, edge_weight, relation, input, mul_type):
+    # computed in float32 for reduced precision inputs, only one chunk of edges is upcast at a time
+    src = _accumulate_type(input.index_select(0, edge_index[0]))
+    rel = _accumulate_type(relation.index_select(0, edge_type))
+    message = src * rel if mul_type == "mul" else src + rel
+    return message, message * edge_weight.unsqueeze(-1)
+
+
+def _accumulate_type(tensor):
+    return tensor.float() if tensor.dtype in (torch.bfloat16, torch.float16) else tensor
+
+
+def _vectorized_forward(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type):
+    num_edge = edge_index.size(1)
+    dim = input.size(1)
+    node_out = edge_index[1]
+
+    if sum_type == "add":
+        output = torch.zeros_like(input, dtype=_accumulate_type(input).dtype)
+    else:
+        output = torch.full_like(input, float("inf") if sum_type == "min" else float("-inf"),
+                                 dtype=_accumulate_type(input).dtype)
+    reduce = "amin" if sum_type == "min" else "amax"
+
+    for start, end in _edge_chunks(num_edge, dim):
+        _, value = _message(edge_index[:, start:end], edge_type[start:end], edge_weight[start:end],
+                            relation, input, mul_type)
+        if sum_type == "add":
+            output.index_add_(0, node_out[start:end], value)
+        else:
+            output.scatter_reduce_(0, node_out[start:end].unsqueeze(-1).expand_as(value), value, reduce)
+
+    if sum_type != "add":
+        # nodes without incoming edges are zero, as in RSPMMFunction
+        has_edge = torch.zeros(output.size(0), dtype=torch.bool, device=output.device)
+        has_edge[node_out] = True
+        output[~has_edge] = 0
+
+    return output.to(input.dtype)
+
+
+def _split_ties(edge_index, edge_type, edge_weight, relation, input, output, grad_output, mul_type):
+    """
+    Divide grad_output by the number of edges reaching the min / max of each output element, so that
+    tied edges share the gradient evenly, as in torch.scatter_reduce with amin / amax.
+    """
+    node_out = edge_index[1]
+    num_tie = torch.zeros_like(output, dtype=_accumulate_type(output).dtype)
+    for start, end in _edge_chunks(edge_index.size(1), input.size(1)):
+        _, value = _message(edge_index[:, start:end], edge_type[start:end], edge_weight[start:end],
+                            relation, input, mul_type)
+        tie = value.to(output.dtype) == output.index_select(0, node_out[start:end])
+        num_tie.index_add_(0, node_out[start:end], tie.to(num_tie.dtype))
+    return _accumulate_type(grad_output) / num_tie.clamp(min=1)
+
+
+def _vectorized_backward(edge_index, edge_type, edge_weight, relation, input, output, grad_output, sum_type, mul_type):
+    if sum_type != "add":
+        grad_output = _split_ties(edge_index, edge_type, edge_weight, relation, input, output, grad_output,
+                                  mul_type)
+    grad_weight = torch.zeros_like(edge_weight)
+    grad_relation = torch.zeros_like(relation, dtype=_accumulate_type(relation).dtype)
+    grad_input = torch.zeros_like(input, dtype=_accumulate_type(input).dtype)
+
+    for start, end in _edge_chunks(edge_index.size(1), input.size(1)):
+        node_in, node_out = edge_index[:, start:end]
+        layer = edge_type[start:end]
+        weight = edge_weight[start:end].unsqueeze(-1)
+
+        grad = _accumulate_type(grad_output.index_select(0, node_out))
+        message, value = _message(edge_index[:, start:end], layer, edge_weight[start:end],
+                                  relation, input, mul_type)
+        if sum_type != "add":
+            # only the edges that produced the min / max receive gradient
+            grad = grad * (value.to(output.dtype) == output.index_select(0, node_out))
+
+        grad_weight[start:end] = (grad * message).sum(-1)
+        grad = grad * weight
+        if mul_type == "mul":
+            grad_input.index_add_(0, node_in, grad * relation.index_select(0, layer))
+            grad_relation.index_add_(0, layer, grad * input.index_select(0, node_in))
+        else:  # add
+            grad_input.index_add_(0, node_in, grad)
+            grad_relation.index_add_(0, layer, grad)
+
+    return grad_weight, grad_relation.to(relation.dtype), grad_input.to(input.dtype)
+
+
+class VectorizedRSPMMFunction(autograd.Function):
+    """
+    Same semantics as RSPMMFunction, computed with gather / index_add_ / scatter_reduce_ over
+    chunks of edges. Messages are never kept for backward, so memory stays O(|V|d + chunk).
+    bfloat16 / float16 inputs are accumulated in float32 and the results are cast back.
+    For min / max, edges tied for the extremum share its gradient evenly.
+    """
+    @staticmethod
+    def forward(ctx, edge_index, edge_type, edge_weight, relation, input, sum_type="add", mul_type="mul"):
+        output = _vectorized_forward(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type)
+        ctx.save_for_backward(edge_index, edge_type, edge_weight, relation, input, output)
+        ctx.sum_type = sum_type
+        ctx.mul_type = mul_type
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_weight, grad_relation, grad_input = _vectorized_backward(*ctx.saved_tensors, grad_output,
+                                                                      ctx.sum_type, ctx.mul_type)
+        return None, None, grad_weight, grad_relation, grad_input, None, None
+
+
+def _cpp_forward(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type):
+    # edge_index is the flipped edge list
+    forward = getattr(_cpp_extension, "rspmm_%s_%s_forward_cpu" % (sum_type, mul_type))
+    output = forward(edge_index, edge_type, edge_weight, relation, input)
+    if sum_type != "add":
+        # the kernel leaves +-max on nodes without incoming edges, RSPMMFunction gives zero
+        has_edge = torch.zeros(output.size(0), dtype=torch.bool, device=output.device)
+        has_edge[edge_index[0]] = True
+        output[~has_edge] = 0
+    return output
+
+
+def _cpp_backward(edge_index, edge_type, edge_weight, relation, input, output, grad_output, sum_type, mul_type):
+    backward = getattr(_cpp_extension, "rspmm_%s_%s_backward_cpu" % (sum_type, mul_type))
+    if sum_type != "add":
+        # the kernel gives the full gradient to every tied edge
+        grad_output = _split_ties(edge_index.flip(0), edge_type, edge_weight, relation, input, output,
+                                  grad_output, mul_type).to(grad_output.dtype)
+    return backward(edge_index, edge_type, edge_weight, relation, input, output, grad_output)
+
+
+class CppRSPMMFunction(autograd.Function):
+    """
+    Wrapper of the compiled CSR kernel. The kernel reduces row = edge_index[0] over col = edge_index[1],
+    so it is given the flipped edge list, which must be sorted by destination.
+    """
+    @staticmethod
+    def forward(ctx, edge_index, edge_type, edge_weight, relation, input, sum_type="add", mul_type="mul"):
+        edge_index = edge_index.flip(0)
+        output = _cpp_forward(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type)
+        ctx.save_for_backward(edge_index, edge_type, edge_weight, relation, input, output)
+        ctx.sum_type = sum_type
+        ctx.mul_type = mul_type
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_weight, grad_relation, grad_input = _cpp_backward(*ctx.saved_tensors, grad_output,
+                                                               ctx.sum_type, ctx.mul_type)
+        return None, None, grad_weight, grad_relation, grad_input, None, None
+
+
+if hasattr(torch.library, "custom_op"):
+    # torch >= 2.4: the vectorized and cpp backends as an opaque operator, so that torch.compile keeps a model
+    # calling generalized_rspmm in one graph instead of breaking around the autograd functions above
+    @torch.library.custom_op("knowformer::rspmm", mutates_args=())
+    def _rspmm_op(edge_index: torch.Tensor, edge_type: torch.Tensor, edge_weight: torch.Tensor,
+                  relation: torch.Tensor, input: torch.Tensor, sum_type: str, mul_type: str,
+                  use_cpp: bool) -> torch.Tensor:
+        if use_cpp:
+            return _cpp_forward(edge_index.flip(0), edge_type, edge_weight, relation, input, sum_type, mul_type)
+        return _vectorized_forward(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type)
+
+    @torch.library.custom_op("knowformer::rspmm_backward", mutates_args=())
+    def _rspmm_backward_op(edge_index: torch.Tensor, edge_type: torch.Tensor, edge_weight: torch.Tensor,
+                           relation: torch.Tensor, input: torch.Tensor, output: torch.Tensor,
+                           grad_output: torch.Tensor, sum_type: str, mul_type: str,
+                           use_cpp: bool) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if use_cpp:
+            return _cpp_backward(edge_index.flip(0), edge_type, edge_weight, relation, input, output,
+                                 grad_output.contiguous(), sum_type, mul_type)
+        return _vectorized_backward(edge_index, edge_type, edge_weight, relation, input, output, grad_output,
+                                    sum_type, mul_type)
+
+    @_rspmm_op.register_fake
+    def _(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type, use_cpp):
+        return torch.empty_like(input)
+
+    @_rspmm_backward_op.register_fake
+    def _(edge_index, edge_type, edge_weight, relation, input, output, grad_output, sum_type, mul_type, use_cpp):
+        return torch.empty_like(edge_weight), torch.empty_like(relation), torch.empty_like(input)
+
+    def _rspmm_setup_context(ctx, inputs, output):
+        edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type, use_cpp = inputs
+        ctx.save_for_backward(edge_index, edge_type, edge_weight, relation, input, output)
+        ctx.sum_type = sum_type
+        ctx.mul_type = mul_type
+        ctx.use_cpp = use_cpp
+
+    def _rspmm_backward(ctx, grad_output):
+        grad_weight, grad_relation, grad_input = _rspmm_backward_op(*ctx.saved_tensors, grad_output,
+                                                                    ctx.sum_type, ctx.mul_type, ctx.use_cpp)
+        return None, None, grad_weight, grad_relation, grad_input, None, None, None
+
+    _rspmm_op.register_autograd(_rspmm_backward, setup_context=_rspmm_setup_context)
+else:
+    _rspmm_op = None
+
+
+def _is_compiling():
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and hasattr(compiler, "is_compiling"):
+        return compiler.is_compiling()
+    return torch._dynamo.is_compiling()
+
+
+def generalized_rspmm(edge_index, edge_type, edge_weight, relation, input, sum="add", mul="mul", backend=None,
+                      presorted=False):
     node_in, node_out = edge_index
-    
+    backend = backend or _backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown rspmm backend `%s`. Available backends are %s" % (backend, BACKENDS))
+
     # Handle empty tensors
     if node_out.numel() == 0:
         # Return empty output tensor with same shape as input
         return torch.zeros_like(input)
-    
-    # Specify dimension for max operation
-    key = node_in * (node_out.max(dim=0)[0] + 1) + node_out
-    order = key.argsort()
-
-    edge_index = edge_index[:, order]
-    edge_type = edge_type[order]
-    edge_weight = edge_weight[order]
-    
-    return RSPMMFunction.apply(edge_index, edge_type, edge_weight, relation, input, sum, mul)
\ No newline at end of file
+
+    # presorted edges, e.g. from Graph.csr, are already grouped by destination
+    if not presorted:
+        # group edges by destination so that every node reduces over a contiguous run of edges
+        key = node_out * (node_in.max(dim=0)[0] + 1) + node_in
+        order = key.argsort()
+
+        edge_index = edge_index[:, order]
+        edge_type = edge_type[order]
+        edge_weight = edge_weight[order]
+
+    # the output has the dtype of input
+    relation = relation.to(input.dtype)
+    if backend in ('cpp', 'loop') and input.dtype != _accumulate_type(input).dtype:
+        # the C++ kernel only handles float32 / float64 and the loop accumulates in the output, so both
+        # run in float32 on reduced precision inputs
+        return generalized_rspmm(edge_index, edge_type, edge_weight, relation.float(), input.float(), sum, mul,
+                                 backend, presorted=True).to(input.dtype)
+    use_cpp = backend == 'cpp' and input.device.type == 'cpu' and load_cpp_extension() is not None
+    if _rspmm_op is not None and backend != 'loop' and _is_compiling():
+        return _rspmm_op(edge_index, edge_type, edge_weight, relation, input, sum, mul, use_cpp)
+    if use_cpp:
+        return CppRSPMMFunction.apply(edge_index, edge_type, edge_weight, relation, input, sum, mul)
+    if backend == 'loop':
+        return RSPMMFunction.apply(edge_index, edge_type, edge_weight, relation, input, sum, mul)
+    return VectorizedRSPMMFunction.apply(edge_index, edge_type, edge_weight, relation, input, sum, mul)
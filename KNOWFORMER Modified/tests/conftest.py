@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import src from the repository root, wherever pytest is started from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
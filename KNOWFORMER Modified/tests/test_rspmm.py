@@ -0,0 +1,126 @@
+import pytest
+import torch
+
+from src.rspmm import generalized_rspmm
+from src.rspmm.rspmm import load_cpp_extension
+
+SUM_TYPES = ['add', 'min', 'max']
+MUL_TYPES = ['mul', 'add']
+
+
+def fast_backends():
+    # the cpp backend falls back to vectorized when the extension does not build, it is only tested if it does
+    backends = ['vectorized']
+    if load_cpp_extension() is not None:
+        backends.append('cpp')
+    return backends
+
+
+def random_graph(seed, num_node=10, num_edge=40, num_relation=4, dim=5):
+    """float64 inputs of generalized_rspmm, node num_node - 1 has no incoming edge"""
+    generator = torch.Generator().manual_seed(seed)
+    node_in = torch.randint(0, num_node, (num_edge,), generator=generator)
+    node_out = torch.randint(0, num_node - 1, (num_edge,), generator=generator)
+    edge_type = torch.randint(0, num_relation, (num_edge,), generator=generator)
+    edge_weight = torch.rand(num_edge, dtype=torch.double, generator=generator)
+    relation = torch.randn(num_relation, dim, dtype=torch.double, generator=generator)
+    input = torch.randn(num_node, dim, dtype=torch.double, generator=generator)
+    return torch.stack([node_in, node_out]), edge_type, edge_weight, relation, input
+
+
+def rspmm_and_grads(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type, backend):
+    edge_weight, relation, input = [x.clone().requires_grad_() for x in [edge_weight, relation, input]]
+    output = generalized_rspmm(edge_index, edge_type, edge_weight, relation, input, sum=sum_type, mul=mul_type,
+                               backend=backend)
+    # a different gradient for every output element
+    grad_output = torch.arange(output.numel(), dtype=output.dtype).view_as(output).sin()
+    output.backward(grad_output)
+    return output.detach(), edge_weight.grad, relation.grad, input.grad
+
+
+def reference_rspmm(edge_index, edge_type, edge_weight, relation, input, sum_type, mul_type):
+    # min / max through scatter_reduce, whose autograd only differentiates the selected message
+    node_in, node_out = edge_index
+    if mul_type == 'mul':
+        message = input[node_in] * relation[edge_type]
+    else:
+        message = input[node_in] + relation[edge_type]
+    message = message * edge_weight.unsqueeze(-1)
+    if sum_type == 'add':
+        return torch.zeros_like(input).index_add(0, node_out, message)
+    index = node_out.unsqueeze(-1).expand_as(message)
+    return torch.zeros_like(input).scatter_reduce(0, index, message, 'a' + sum_type, include_self=False)
+
+
+@pytest.mark.parametrize('backend', fast_backends())
+@pytest.mark.parametrize('sum_type', SUM_TYPES)
+@pytest.mark.parametrize('mul_type', MUL_TYPES)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_forward_matches_loop(backend, sum_type, mul_type, seed):
+    graph = random_graph(seed)
+    output = generalized_rspmm(*graph, sum=sum_type, mul=mul_type, backend=backend)
+    expected = generalized_rspmm(*graph, sum=sum_type, mul=mul_type, backend='loop')
+    torch.testing.assert_close(output, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('backend', fast_backends())
+@pytest.mark.parametrize('mul_type', MUL_TYPES)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_add_backward_matches_loop(backend, mul_type, seed):
+    graph = random_graph(seed)
+    grads = rspmm_and_grads(*graph, 'add', mul_type, backend)[1:]
+    expected = rspmm_and_grads(*graph, 'add', mul_type, 'loop')[1:]
+    for grad, expected_grad in zip(grads, expected):
+        torch.testing.assert_close(grad, expected_grad, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('backend', fast_backends())
+@pytest.mark.parametrize('sum_type', ['min', 'max'])
+@pytest.mark.parametrize('mul_type', MUL_TYPES)
+def test_min_max_backward_selects_one_edge(backend, sum_type, mul_type):
+    # The loop backend sends the gradient of a min / max to every incoming edge, for input and relation as for
+    # add, and none to edge_weight. The other backends only send it to the edge that was selected.
+    graph = random_graph(0)
+    loop_grads = rspmm_and_grads(*graph, sum_type, mul_type, 'loop')[1:]
+    loop_add_grads = rspmm_and_grads(*graph, 'add', mul_type, 'loop')[1:]
+    assert torch.count_nonzero(loop_grads[0]) == 0
+    torch.testing.assert_close(loop_grads[1], loop_add_grads[1])
+    torch.testing.assert_close(loop_grads[2], loop_add_grads[2])
+
+    grads = rspmm_and_grads(*graph, sum_type, mul_type, backend)[1:]
+    leaves = [x.clone().requires_grad_() for x in graph[2:]]
+    output = reference_rspmm(*graph[:2], *leaves, sum_type, mul_type)
+    output.backward(torch.arange(output.numel(), dtype=output.dtype).view_as(output).sin())
+    for grad, leaf, loop_grad in zip(grads, leaves, loop_grads):
+        torch.testing.assert_close(grad, leaf.grad, rtol=0, atol=1e-12)
+        assert not torch.allclose(grad, loop_grad)
+
+
+@pytest.mark.parametrize('backend', fast_backends())
+@pytest.mark.parametrize('sum_type', ['min', 'max'])
+@pytest.mark.parametrize('mul_type', MUL_TYPES)
+def test_min_max_backward_splits_ties(backend, sum_type, mul_type):
+    # duplicated edges give exactly the same message, tied edges share the gradient like scatter_reduce
+    edge_index, edge_type, edge_weight, relation, input = random_graph(0)
+    duplicate = torch.arange(10).repeat(2)
+    graph = (torch.cat([edge_index, edge_index[:, duplicate]], dim=1), torch.cat([edge_type, edge_type[duplicate]]),
+             torch.cat([edge_weight, edge_weight[duplicate]]), relation, input)
+
+    grads = rspmm_and_grads(*graph, sum_type, mul_type, backend)[1:]
+    leaves = [x.clone().requires_grad_() for x in graph[2:]]
+    output = reference_rspmm(*graph[:2], *leaves, sum_type, mul_type)
+    output.backward(torch.arange(output.numel(), dtype=output.dtype).view_as(output).sin())
+    for grad, leaf in zip(grads, leaves):
+        torch.testing.assert_close(grad, leaf.grad, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('backend', fast_backends())
+@pytest.mark.parametrize('sum_type', SUM_TYPES)
+@pytest.mark.parametrize('mul_type', MUL_TYPES)
+def test_gradcheck(backend, sum_type, mul_type):
+    edge_index, edge_type, edge_weight, relation, input = random_graph(2, num_node=6, num_edge=15, dim=3)
+    function = lambda edge_weight, relation, input: generalized_rspmm(edge_index, edge_type, edge_weight, relation,
+                                                                      input, sum=sum_type, mul=mul_type,
+                                                                      backend=backend)
+    inputs = [x.requires_grad_() for x in [edge_weight, relation, input]]
+    assert torch.autograd.gradcheck(function, inputs)